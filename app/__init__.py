@@ -4,7 +4,7 @@
 import logging #importing the logging module to set up error logging
 from logging.handlers import SMTPHandler, RotatingFileHandler #importing necessary modules for logging
 import os
-from flask import Flask, request, current_app
+from flask import Flask, request, current_app, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
@@ -19,6 +19,9 @@ from redis import Redis
 import rq
 
 def get_locale():
+    if not has_request_context():
+        return None
+        #background tasks have no request, babel falls back to the default locale
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
     #this uses the attribute of Flask's request object called accept_languages. 
     #this provides an interface to work with the Accept-Language header that clients send with a request.
@@ -37,6 +40,30 @@ mail = Mail()
 moment = Moment()
 babel = Babel()
 
+def connect_elasticsearch():
+    #creates the Elasticsearch client from the environment variables, also used by the reindex worker processes (app/search.py)
+    es_url = os.environ.get('ELASTICSEARCH_URL') #getting the elasticsearch url from environment variable
+    if es_url:
+        es_url = es_url.strip()
+    else:
+        None 
+    es_user = os.environ.get('ELASTICSEARCH_USER') #getting the elasticsearch user from environment variable
+    es_password = os.environ.get('ELASTICSEARCH_PASSWORD') #getting the elasticsearch password from environment variable
+
+    if es_url:
+        es_kwargs = {}  #initializing an empty dictionary to hold elasticsearch connection parameters
+        if es_user and es_password:
+            es_kwargs['basic_auth'] = (es_user, es_password)
+            #if both user and password are provided, add them to the es_kwargs dictionary for basic authentication
+        ca_path = os.environ.get("ELASTICSEARCH_CA_CERT")  #getting the path to the CA certificate from environment variable
+        if es_url.startswith('https') and ca_path:
+            es_kwargs['ca_certs'] = ca_path
+            #if a CA certificate path is provided, add it to the es_kwargs dictionary for secure connection
+        return Elasticsearch([es_url], **es_kwargs)
+        #create an instance of the Elasticsearch client
+    return None #if the elasticsearch url does not exist there is no client
+
+
 def create_app(config_class=Config):
     #function to create the flask app instance
     app = Flask(__name__)
@@ -58,27 +85,8 @@ def create_app(config_class=Config):
     #we that task queue is accessible via current_app.task_queue anywhere
 
 
-    es_url = os.environ.get('ELASTICSEARCH_URL') #getting the elasticsearch url from environment variable
-    if es_url:
-        es_url = es_url.strip()
-    else:
-        None 
-    es_user = os.environ.get('ELASTICSEARCH_USER') #getting the elasticsearch user from environment variable
-    es_password = os.environ.get('ELASTICSEARCH_PASSWORD') #getting the elasticsearch password from environment variable
-
-    if es_url:
-        es_kwargs = {}  #initializing an empty dictionary to hold elasticsearch connection parameters
-        if es_user and es_password:
-            es_kwargs['basic_auth'] = (es_user, es_password)
-            #if both user and password are provided, add them to the es_kwargs dictionary for basic authentication
-        ca_path = os.environ.get("ELASTICSEARCH_CA_CERT")  #getting the path to the CA certificate from environment variable
-        if es_url.startswith('https') and ca_path:
-            es_kwargs['ca_certs'] = ca_path
-            #if a CA certificate path is provided, add it to the es_kwargs dictionary for secure connection
-        app.elasticsearch = Elasticsearch([es_url], **es_kwargs)
-        #create an instance of the Elasticsearch client and attach it to the app instance
-    else:
-        app.elasticsearch = None #if the elasticsearch url does not exist, set the app.elasticsearch attribute to None
+    app.elasticsearch = connect_elasticsearch()
+    #create an instance of the Elasticsearch client and attach it to the app instance, None when it is not configured
 
     #when a blueprint is registered with the app, all the routes,view functions, static files and error handlers defined in that blueprint become part of the application
     from app.errors import bp as errors_bp #importing the errors blueprint from app/errors/__init__.py
@@ -140,6 +148,14 @@ def create_app(config_class=Config):
 #importing routes, errors and models at the bottom avoids circular imports as routes also needs to import the app instance
 from app import models
 #the database model will define the structure of the database tables used in the application
+from app import timeline
+#the timeline module registers the session listeners that keep the home timelines in sync with the posts
+from app import unread
+#same for the unread message counters shown in the navbar
+from app import language
+#and for the language detection of new posts
+from app import notifications
+#and for pushing the notifications to the open pages
 
 
 #instead of having to set the FLASK_APP environment variable, we can register it automatically using python-dotenv
@@ -25,8 +25,12 @@ def get_users():
     #extract page and per_page from the query string of the request
     #using defaults of 1 and 10 if they are not defined
     return User.to_collection_dict(sa.select(User), page, per_page,
-                                   'api.get_users')
+                                   'api.get_users', request.args.get('before'),
+                                   request.args.get('after'),
+                                   count=request.args.get('count', 1, type=int) != 0)
     #pass page and per_page into the method along with the a query that returns all users(sa.select(User))
+    #a before= or after= cursor in the query string switches to keyset pagination
+    #count=0 skips the COUNT(*) for clients that don't need total_items/total_pages
     #api.get_users is the endpoint name that are needed for the links
 
 
@@ -38,7 +42,9 @@ def get_followers(id):
     #get the user from the db
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers', id=id)
+    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers',
+                                   request.args.get('before'), request.args.get('after'),
+                                   count=request.args.get('count', 1, type=int) != 0, id=id)
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
@@ -47,7 +53,9 @@ def get_following(id):
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
     return User.to_collection_dict(user.following.select(), page, per_page,
-                                   'api.get_following', id=id)
+                                   'api.get_following', request.args.get('before'),
+                                   request.args.get('after'),
+                                   count=request.args.get('count', 1, type=int) != 0, id=id)
 
 @bp.route('/users', methods=['POST'])
 #the decorator is not added to this view function since the user that will request the token needs to be created first
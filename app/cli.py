@@ -2,6 +2,10 @@ import os
 import click #this file defines custom command line commands for managing translations in the Flask app
 from app import current_app #importing the app instance from the app package
 from flask import Blueprint #importing Blueprint class from Flask to create a CLI blueprint
+import sqlalchemy as sa
+from app import db, language, notifications, presence, worker as rq_worker
+from app.translate import pretranslate
+from app.models import User, Post, Message, SearchableMixin, followers
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -44,4 +48,163 @@ def compile():
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
 #this function compiles all language translations
-#it converts the .po files into .mo files that can be used by the Flask-Babel extension at runtime
\ No newline at end of file
+#it converts the .po files into .mo files that can be used by the Flask-Babel extension at runtime
+
+
+@translate.command()
+@click.option('--hours', type=int, default=None, help='Translate the posts of the last HOURS hours.')
+@click.option('--budget', type=int, default=None, help='The most characters sent to the translator.')
+@click.option('--rate', type=int, default=None, help='The most characters per second.')
+@click.option('--sync', is_flag=True, help='Run in this process instead of the task queue.')
+def prewarm(hours, budget, rate, sync):
+    """Pre-translate recent posts into the locales of active users."""
+    options = {
+        'hours': hours or current_app.config['TRANSLATION_PREWARM_HOURS'],
+        'budget': budget or current_app.config['TRANSLATION_PREWARM_BUDGET'],
+        'rate': rate or current_app.config['TRANSLATION_PREWARM_RATE'],
+    }
+    if not sync:
+        job = current_app.task_queue.enqueue('app.tasks.pretranslate_posts', job_timeout=3600, **options)
+        click.echo(f'Queued pre-translation job {job.get_id()}.')
+        return
+    result = pretranslate(**options)
+    click.echo(f"Translated {result['translated']} texts ({result['characters']} characters) of "
+               f"{result['posts']} posts into {', '.join(result['locales']) or 'no locales'}, "
+               f"{result['cached']} were already cached.")
+    if result['budget_exhausted']:
+        click.echo('Stopped at the character budget.')
+    if result['error']:
+        click.echo(f"Stopped: {result['error']}")
+#this command fills the translation cache so most Translate clicks don't wait for the translator
+#cron runs it, e.g. every hour: "flask translate prewarm", and an RQ worker runs the queued job
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+#this group holds the commands that maintain the num_posts, num_followers, num_following and num_unread_messages columns of User
+
+
+@counters.command()
+def repair():
+    """Recompute the post, follow and unread message counters of every user."""
+    user = User.__table__
+    posts = sa.select(sa.func.count()).where(Post.user_id == user.c.id).scalar_subquery()
+    num_followers = sa.select(sa.func.count()).where(followers.c.followed_id == user.c.id).scalar_subquery()
+    num_following = sa.select(sa.func.count()).where(followers.c.follower_id == user.c.id).scalar_subquery()
+    unread = sa.select(sa.func.count()).where(
+        Message.recipient_id == user.c.id,
+        sa.or_(user.c.last_message_read_time.is_(None), Message.timestamp > user.c.last_message_read_time)
+    ).scalar_subquery()
+    #each counter is recomputed with a correlated subquery, all users are fixed with a single UPDATE
+    result = db.session.execute(
+        sa.update(user).where(sa.or_(user.c.num_posts != posts,
+                                     user.c.num_followers != num_followers,
+                                     user.c.num_following != num_following,
+                                     user.c.num_unread_messages != unread))
+        .values(num_posts=posts, num_followers=num_followers, num_following=num_following,
+                num_unread_messages=unread))
+    #only the rows that are out of date are written
+    db.session.commit()
+    click.echo(f'Repaired the counters of {result.rowcount} users.')
+
+
+@bp.cli.group('language')
+def language_group():
+    """Post language detection commands."""
+    pass
+#this group holds the commands for the language detection of app/language.py
+
+
+@language_group.command()
+@click.option('--batch', type=int, default=500, help='Posts read and updated per transaction.')
+def backfill(batch):
+    """Detect the language of the posts that don't have one."""
+    count = language.detect_posts(batch=batch, retry=True)
+    click.echo(f'Detected the language of {count} posts.')
+#the new posts are detected by the worker, this is for the posts written before or while no worker was running
+#the detection is seeded (LANGUAGE_DETECTION_SEED), so running it again gives the same languages
+
+
+@bp.cli.group('notifications')
+def notifications_group():
+    """Notification store commands."""
+    pass
+
+
+@notifications_group.command('flush')
+def flush_notifications():
+    """Write the notifications waiting in redis to the database."""
+    if current_app.config['NOTIFICATION_BACKEND'] != 'redis':
+        click.echo('The notifications are written to the database directly.')
+        return
+    count = notifications.flush()
+    click.echo(f'Wrote {count} notifications.')
+#commits already write the dirty users back every NOTIFICATION_FLUSH_INTERVAL seconds,
+#this is for cron or before redis is restarted
+
+
+@bp.cli.group('last-seen')
+def last_seen():
+    """Buffered last_seen commands."""
+    pass
+#this group holds the commands for the last_seen buffer of app/presence.py
+
+
+@last_seen.command()
+def flush():
+    """Write the buffered last_seen times to the database."""
+    count = presence.flush()
+    click.echo(f'Updated last_seen of {count} users.')
+#the buffer is also flushed by the requests every LAST_SEEN_FLUSH_INTERVAL seconds,
+#this command can run from cron, or before a deploy so no buffered times are lost
+
+
+@bp.cli.command()
+@click.option('--mode', type=click.Choice(list(rq_worker.WORKERS)), default='fork',
+              help='Fork a work horse for each job, or run the jobs in this process.')
+@click.option('--queue', 'queues', multiple=True, help='Queue to listen on, the task queue by default.')
+@click.option('--burst', is_flag=True, help='Quit once the queues are empty.')
+def worker(mode, queues, burst):
+    """Run an RQ worker for the background tasks."""
+    w = rq_worker.create_worker(mode, list(queues))
+    click.echo(f'Listening on {", ".join(w.queue_names())} ({mode}).')
+    w.work(burst=burst, logging_level='INFO')
+#this replaces "rq worker microblog-tasks", the app is built once here instead of in every job (app/worker.py)
+#REDIS_URL and DATABASE_URL come from the environment or .env like for the web process
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command()
+@click.argument('index', default='post')
+@click.option('--chunk-size', default=10000, help='Ids per bulk request.')
+@click.option('--workers', default=4, help='Worker processes, 1 indexes in this process.')
+@click.option('--new-index', is_flag=True, help='Build a new index and swap it in behind the alias. Posts written '
+              'during the build are copied, but edits and deletes of posts already copied are not.')
+@click.option('--resume', is_flag=True, help='Carry on from the last saved position.')
+@click.option('--state-file', default=None, help='Progress file, reindex-<index>.json by default.')
+def reindex(index, chunk_size, workers, new_index, resume, state_file):
+    """Rebuild a search index from the database."""
+    models = {model.__tablename__: model for model in SearchableMixin.__subclasses__()}
+    if index not in models:
+        raise click.BadParameter(f'unknown index, use one of: {", ".join(models)}')
+
+    def progress(rows, elapsed):
+        click.echo(f'{rows} rows, {rows / elapsed if elapsed else 0:.0f} rows/s')
+    try:
+        result = models[index].reindex(chunk_size=chunk_size, workers=workers, new_index=new_index,
+                                       resume=resume, state_path=state_file, progress=progress)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Indexed {result['rows']} rows into {result['target']} in {result['seconds']:.1f}s "
+               f"({result['rows'] / result['seconds'] if result['seconds'] else 0:.0f} rows/s), "
+               f"{result['failed']} failed.")
+    if not result['complete']:
+        click.echo('Some documents failed, run the command again with --resume to send their ranges again.')
+#if the command is interrupted, run it again with --resume to carry on from the last range that was indexed
@@ -0,0 +1,128 @@
+import gzip
+import json
+import os
+import tempfile
+from time import time
+import jwt
+import sqlalchemy as sa
+from flask import current_app, render_template, url_for
+from app import db
+from app.email import send_email
+from app.models import Post
+
+#this file writes the post archives of the export_posts task (app/tasks.py)
+#the task used to load every post, build a list of dicts and json.dumps(..., indent=4) it into the email,
+#so the worker held all the posts several times over and a big account could run it out of memory
+#now the posts are read in batches of EXPORT_BATCH rows and written as they come to a gzip file on disk,
+#one JSON object per line (NDJSON), so the memory used is one batch whatever the number of posts
+#small archives are attached to the email, bigger ones stay in EXPORT_DIR and the email has a signed download link
+
+FILENAME = 'posts.ndjson.gz'
+#the name the user gets, in the attachment or the download
+
+
+def write_posts(user, fileobj, progress=None, batch=None):
+    #writes the posts of the user to fileobj as gzip compressed NDJSON, oldest first, returns how many were written
+    #progress is a ProgressReporter (app/progress.py), updated after each batch
+    batch = batch or current_app.config['EXPORT_BATCH']
+    query = sa.select(Post.id, Post.body, Post.timestamp).where(Post.user_id == user.id).order_by(
+        Post.timestamp.asc(), Post.id.asc()).limit(batch)
+    count = 0
+    last = None
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as archive:
+        while True:
+            page = query if last is None else query.where(sa.tuple_(Post.timestamp, Post.id) > last)
+            with db.engine.connect() as connection:
+                rows = connection.execute(page).all()
+            #each batch is a short query of its own (keyset on timestamp, id) on a connection that is given back
+            #before the progress update commits, sqlite can't commit while another connection still has a cursor
+            #open. the session of the caller is left alone
+            if not rows:
+                break
+            last = (rows[-1].timestamp, rows[-1].id)
+            archive.write(''.join(json.dumps({
+                'body': row.body,
+                'timestamp': row.timestamp.isoformat() + 'Z'
+            }) + '\n' for row in rows).encode('utf-8'))
+            count += len(rows)
+            if progress is not None:
+                progress.update(count)
+    return count
+
+
+def new_file(user):
+    #creates an empty archive file in EXPORT_DIR and returns its path
+    os.makedirs(current_app.config['EXPORT_DIR'], exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=f'posts-{user.id}-', suffix='.ndjson.gz',
+                                dir=current_app.config['EXPORT_DIR'])
+    os.close(fd)
+    return path
+
+
+def get_token(user, path):
+    #a signed token for the download link, it names the file and the user it belongs to
+    return jwt.encode({'export': os.path.basename(path), 'user': user.id,
+                       'exp': time() + current_app.config['EXPORT_LINK_EXPIRES']},
+                      current_app.config['SECRET_KEY'], algorithm='HS256')
+
+
+def verify_token(token, user):
+    #returns the path of the archive if the token is valid, belongs to the user and the file is still there
+    try:
+        payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+    except jwt.PyJWTError:
+        return None
+    if payload.get('user') != user.id:
+        return None
+    path = os.path.join(current_app.config['EXPORT_DIR'], os.path.basename(payload.get('export', '')))
+    return path if os.path.isfile(path) else None
+
+
+def download_url(user, path):
+    #the tasks run outside a request, EXPORT_URL is the address of the site used to build the link
+    with current_app.test_request_context(base_url=current_app.config['EXPORT_URL']):
+        return url_for('main.download_export', token=get_token(user, path), _external=True)
+
+
+def send_archive(user, path):
+    #emails the archive to the user, attached if it is at most EXPORT_ATTACHMENT_LIMIT bytes, else as a link
+    #the attached archives are deleted once sent, the linked ones by prune() when the link expires
+    #without EXPORT_URL there is no way to link to a bigger archive, the email says it is too big and the file is
+    #deleted: attaching it would read it all into memory, which is what the export is written not to do
+    link = None
+    attachments = None
+    too_big = os.path.getsize(path) > current_app.config['EXPORT_ATTACHMENT_LIMIT']
+    if not too_big:
+        with open(path, 'rb') as f:
+            attachments = [(FILENAME, 'application/gzip', f.read())]
+    elif current_app.config['EXPORT_URL']:
+        link = download_url(user, path)
+    else:
+        current_app.logger.error(f'The archive of {user.username} is over EXPORT_ATTACHMENT_LIMIT and EXPORT_URL '
+                                 f'is not set, it can not be sent')
+    days = current_app.config['EXPORT_LINK_EXPIRES'] // (24 * 3600)
+    send_email(
+        '[Microblog] Your blog posts',
+        sender=current_app.config['ADMINS'][0],
+        recipients=[user.email],
+        text_body=render_template('email/export_posts.txt', user=user, link=link, days=days, too_big=too_big),
+        html_body=render_template('email/export_posts.html', user=user, link=link, days=days, too_big=too_big),
+        attachments=attachments,
+        sync=True)
+    if link is None:
+        os.remove(path)
+    return link
+
+
+def prune():
+    #deletes the archives whose download link has expired, returns how many were deleted
+    directory = current_app.config['EXPORT_DIR']
+    if not os.path.isdir(directory):
+        return 0
+    deadline = time() - current_app.config['EXPORT_LINK_EXPIRES']
+    count = 0
+    for entry in os.scandir(directory):
+        if entry.name.startswith('posts-') and entry.is_file() and entry.stat().st_mtime < deadline:
+            os.remove(entry.path)
+            count += 1
+    return count
@@ -0,0 +1,117 @@
+import threading
+import redis
+import sqlalchemy as sa
+from flask import current_app
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+from app import db
+from app.models import Post
+
+#this file detects the language of the posts after they are written
+#main.index used to run langdetect before inserting every post, the first call of a process loads all the language
+#profiles and every call costs milliseconds of CPU, all on the request of the user writing the post
+#now the post is inserted with language NULL and detected after the commit, selected with LANGUAGE_DETECTION_MODE:
+#'async' enqueues the detect_post_languages task (app/tasks.py), a worker detects all the pending posts in batches
+#'sync' detects the posts of the commit in the process that committed (tests and setups without a worker)
+#language NULL means "not detected yet", '' means langdetect could not tell
+
+QUEUED = 'language:queued'
+#set while a detection job waits in the queue, so a burst of posts enqueues one job instead of one per post
+
+_factory = None
+_lock = threading.Lock()
+
+
+def warm():
+    #loads the language profiles, called when the worker starts so the first job doesn't pay for it
+    global _factory
+    with _lock:
+        if _factory is None:
+            factory = DetectorFactory()
+            factory.load_profile(PROFILES_DIRECTORY)
+            factory.set_seed(current_app.config['LANGUAGE_DETECTION_SEED'])
+            #langdetect samples n-grams at random, a fixed seed gives the same language for the same text every time
+            #so a backfill can be run again and gives the same results
+            _factory = factory
+    return _factory
+
+
+def detect(texts):
+    #returns the language of each text, '' for the texts langdetect can't tell
+    factory = warm()
+    languages = []
+    for text in texts:
+        detector = factory.create()
+        detector.append(text)
+        try:
+            languages.append(detector.detect())
+        except LangDetectException:
+            languages.append('')
+    return languages
+
+
+def detect_posts(ids=None, batch=500, retry=False):
+    #detects the language of the posts with a NULL language, only the given ids if there are any
+    #retry=True also detects again the posts langdetect could not tell before (language ''), for backfills
+    #the posts are read batch at a time and written with one executemany UPDATE per batch, returns how many were detected
+    post = Post.__table__
+    pending = post.c.language.is_(None)
+    if retry:
+        pending = sa.or_(pending, post.c.language == '')
+    query = sa.select(post.c.id, post.c.body).where(pending).order_by(post.c.id).limit(batch)
+    if ids is not None:
+        query = query.where(post.c.id.in_(ids))
+    update = sa.update(post).where(post.c.id == sa.bindparam('post_id'), pending).values(
+        language=sa.bindparam('detected'))
+    #the pending condition leaves alone a post whose language was set in the meantime
+    count = 0
+    last_id = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(query.where(post.c.id > last_id)).all()
+            if not rows:
+                return count
+            languages = detect([row.body for row in rows])
+            connection.execute(update, [{'post_id': row.id, 'detected': language}
+                                        for row, language in zip(rows, languages)])
+        #each batch is a transaction on a connection of its own, like presence.flush()
+        count += len(rows)
+        last_id = rows[-1].id
+
+
+def schedule(ids):
+    #called after a commit that inserted posts without a language
+    if current_app.config['LANGUAGE_DETECTION_MODE'] != 'async':
+        detect_posts(ids)
+        return
+    try:
+        if current_app.redis.set(QUEUED, 1, nx=True, ex=600):
+            current_app.task_queue.enqueue('app.tasks.detect_post_languages')
+        #the job detects every pending post, not just these ids, so if one is waiting already there is nothing to do
+        #the key expires in case a job is lost, the pending posts are then picked up by the next one
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error queueing language detection: {e}")
+        #the posts keep language NULL until the next job or "flask language backfill"
+
+
+def after_flush(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.language is None:
+            session.info.setdefault('language_pending', []).append(obj.id)
+    #the ids are known after the flush, the posts are detected after the commit
+
+
+def after_commit(session):
+    pending = session.info.pop('language_pending', None)
+    if pending:
+        schedule(pending)
+
+
+def after_rollback(session):
+    session.info.pop('language_pending', None)
+
+
+db.event.listen(db.session, 'after_flush', after_flush)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+#these listeners run the detection after the post is committed, like the ones in app/timeline.py
@@ -1,31 +1,32 @@
 from datetime import datetime, timezone
 from flask import render_template, flash, redirect, url_for, request, g, \
-    current_app
+    current_app, abort, send_file
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from app import db
+import sqlalchemy.orm as so
+from app import db, export, notifications as notification_stream, presence, timeline, unread
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate
+from app.models import User, Post, Message
+from app.translate import translate, translate_posts, MAX_BATCH
 from app.main import bp
+from app.pagination import cursor_paginate
 from flask import jsonify
 from app.main.forms import SearchForm
 
 @bp.before_request
 def before_request():
+    g.locale = str(get_locale())
+    #this sets the locale for the current request using the get_locale() function defined in app
+    #the locale is stored in the g object, which is a global namespace for holding data during a request
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        presence.touch(current_user, g.locale)
         #this function is executed before every request, if the user is authenticated
-        #it updates the last_seen field of the current_user to the current UTC time
+        #it records the current UTC time as the last_seen of the current_user, and the locale they read the site in
+        #the time is buffered and written in batches (app/presence.py), so a page view does not commit
         g.search_form = SearchForm()
         #g is a special object provided by Flask that is used to store data during the request
         #this creates an instance of the SearchForm and assigns it to g.search_form
-    g.locale = str(get_locale())
-    #this sets the locale for the current request using the get_locale() function defined in app
-    #the locale is stored in the g object, which is a global namespace for holding data during a request
 
 
 #this is a view function(handlers for the application routes)
@@ -40,15 +41,9 @@ def index():
 #the app.route() decorator takes the URL pattern as an argument and associates it with the index() function
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-            #this uses the detect() function from langdetect to determine the language of the post content
-        except LangDetectException:
-            language = ''
-            #if language detection fails, set language to an empty string
-            #this inserts a new Post record into the database
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         #takes the data entered into the text area box in the post form and the author(current user)
+        #the language is left NULL, app/language.py detects it after the commit so the request doesn't wait for langdetect
         db.session.add(post)
         db.session.commit()
         flash(_('Your post is now live!'))
@@ -56,16 +51,22 @@ def index():
         #this allows the user to refresh the page after a submission
     #posts = db.session.scalars(current_user.following_posts()).all()
     #this queries the database for all the post of the users that the current user follows 
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    before = request.args.get('before')
+    after = request.args.get('after')
+    #the pages are addressed with opaque cursors instead of page numbers (app/pagination.py)
+    posts = timeline.paginate(current_user, current_app.config['POSTS_PER_PAGE'], before, after)
+    #the page is read from the user's materialized home timeline (app/timeline.py)
+    if posts is None:
+        #the timeline is cold or the page is older than the timeline keeps, so we run the full query
+        posts = cursor_paginate(current_user.following_posts(), current_app.config['POSTS_PER_PAGE'],
+                                (Post.timestamp, Post.id), before, after)
     
     next_url=None
     prev_url=None
     if posts.has_next:
-        next_url = url_for('main.index', page=posts.next_num)
+        next_url = url_for('main.index', **posts.next_args)
     if posts.has_prev:
-        prev_url = url_for('main.index', page=posts.prev_num)
+        prev_url = url_for('main.index', **posts.prev_args)
     return render_template('index.html', title=_('Home'), form=form,
                            posts=posts.items, next_url=next_url,
                            prev_url=prev_url, delete_form=EmptyForm()) #the template now recieves the form object as an additional argument, so it can render it to the page 
@@ -137,21 +138,21 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())   
+    query = sa.select(Post).order_by(Post.timestamp.desc()).options(so.selectinload(Post.author))
+    #the authors of the page are loaded with one query instead of one query per post in _post.html
     #posts = db.session.scalars(query).all()
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    #error_out flag: if true when an out of range page is requested a 404 error will be automatically returned to the client.
-    #error_out flag: if false, an empty list will be returned for out of range pages
+    posts = cursor_paginate(query, current_app.config['POSTS_PER_PAGE'], (Post.timestamp, Post.id),
+                            request.args.get('before'), request.args.get('after'))
+    #keyset pagination: the next page is the posts older than the last one on this page, so deep pages cost the same as the first
     #items contains the list of items in the requested page.
 
     next_url=None
     prev_url=None
     
     if posts.has_next:
-        next_url = url_for('main.explore', page=posts.next_num)
+        next_url = url_for('main.explore', **posts.next_args)
     if posts.has_prev:
-        prev_url = url_for('main.explore', page=posts.prev_num)
+        prev_url = url_for('main.explore', **posts.prev_args)
     return render_template('index.html', title=_('Explore'), next_url=next_url, prev_url=prev_url, posts=posts.items, delete_form=EmptyForm())
     #i reuse the index template but do not include the form argument since i dont want the form to write blog posts
 
@@ -168,6 +169,24 @@ def translate_text():
     #this calls the translate() function from app/translate.py to perform the translation
 
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    #translates many posts in one round trip, the page sends {"posts": [{"id": 1, "dest_language": "es"}, ...]}
+    #the posts are grouped by language pair, so the translator is called once per pair instead of once per post
+    data = request.get_json(silent=True) or {}
+    try:
+        pairs = [(int(item['id']), str(item['dest_language'])) for item in data['posts']]
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if len(pairs) > MAX_BATCH:
+        abort(400)
+    translations = translate_posts(pairs)
+    return jsonify({'translations': [
+        {'id': post_id, 'dest_language': dest_language, 'text': text}
+        for (post_id, dest_language), text in translations.items()]})
+
+
 @bp.route('/user/<username>')
 #decorator to define a route with a dynamic segment <username> which captures the username from the URL
 @login_required 
@@ -175,18 +194,18 @@ def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
     #db.first_or_404 queries the database for a User with the given username
     #if no such user exists, it returns a 404 error
-    page = request.args.get('page', 1, type=int)
-    #this gets the page number from the query parameters, defaulting to 1 if not provided
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    query = user.posts.select().order_by(Post.timestamp.desc()).options(so.selectinload(Post.author))
+    posts = cursor_paginate(query, current_app.config['POSTS_PER_PAGE'], (Post.timestamp, Post.id),
+                            request.args.get('before'), request.args.get('after'))
+    #this gets the page of posts after/before the cursors in the query parameters, the first page if there are none
 
     prev_url=None
     next_url=None
     
     if posts.has_next:
-        next_url = url_for('main.user', username=user.username, page=posts.next_num)
+        next_url = url_for('main.user', username=user.username, **posts.next_args)
     if posts.has_prev:
-        prev_url = url_for('main.user', username=user.username, page=posts.prev_num)
+        prev_url = url_for('main.user', username=user.username, **posts.prev_args)
     #this route displays the profile page for a user with the given username
     form = EmptyForm()
     return render_template('user.html',form=form,
@@ -199,18 +218,15 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     #this checks if the search form is valid, if not it redirects to the explore page
-    page = request.args.get('page', 1, type=int)
-    if page < 1:
-        page = 1
-    #this gets the page number from the query parameters, defaulting to 1 if not provided
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
-    #this calls the search method of the Post model(SearchableMixin class) to perform the search using the query from the search form
-    #it retrieves the matching posts and the total number of results
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1)
-    #this constructs the URL for the next page of results
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1)
+    posts = Post.search_cursor(g.search_form.q.data, current_app.config['POSTS_PER_PAGE'],
+                               request.args.get('before'), request.args.get('after'))
+    #this calls the search_cursor method of the Post model(SearchableMixin class) to perform the search using the query from the search form
+    #it retrieves one page of matching posts, the before/after cursors from the links say where the page starts
+    next_url = url_for('main.search', q=g.search_form.q.data, **posts.next_args) if posts.has_next else None
+    #this constructs the URL for the next page of results, there is none past the last page
+    prev_url = url_for('main.search', q=g.search_form.q.data, **posts.prev_args) if posts.has_prev else None
     #this constructs the URL for the previous page of results
-    return render_template('search.html', title=_('Search'), posts=posts,
+    return render_template('search.html', title=_('Search'), posts=posts.items,
                            next_url=next_url, prev_url=prev_url, delete_form=EmptyForm())
     #this renders the search.html template with the search results and pagination links
 
@@ -230,11 +246,14 @@ def send_message(recipient):
     #find the user by search through the database using the userna,e
     form = MessageForm()
     if form.validate_on_submit():
+        count = user.unread_message_count() + 1
+        #the counter (app/unread.py) is bumped when the message is written, the notification carries the new count
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         #takes in the arguments to be stored into the database
         db.session.add(msg)
-        user.add_notification('unread_message_count', user.unread_message_count())
+        user.add_notification('unread_message_count', count)
         db.session.commit()
+        #the message, the counter and the notification are written in one transaction
         flash(_('Your message has been sent'))
         return redirect(url_for('main.user', username=recipient))
     return render_template('send_messages.html', title=_('Send Message'), form=form, recipient=recipient)
@@ -245,19 +264,22 @@ def send_message(recipient):
 def messages():
     current_user.last_message_read_time = datetime.now(timezone.utc)
     #i update the last read time with the current time
+    unread.reset(current_user)
+    #the unread counter goes back to zero together with the last read time
     current_user.add_notification('unread_message_count', 0)
     #when the user enters the message page, the message count goes to zero
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
+    query = current_user.messages_received.select().order_by(Message.timestamp.desc()).options(
+        so.selectinload(Message.author))
     #i query the messages model for the list of messages from newer to older
-    messages = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    messages = cursor_paginate(query, current_app.config['POSTS_PER_PAGE'], (Message.timestamp, Message.id),
+                               request.args.get('before'), request.args.get('after'))
     if messages.has_next:
-        next_url = url_for('main.messages', page=messages.next_num)
+        next_url = url_for('main.messages', **messages.next_args)
     else:
         next_url = None
     if messages.has_prev:
-        prev_url = url_for('main.messages', page=messages.prev_num)
+        prev_url = url_for('main.messages', **messages.prev_args)
     else:
         prev_url = None
     return render_template('messages.html', messages=messages.items,
@@ -267,16 +289,32 @@ def messages():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    query = current_user.notifications.select().where(Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    return jsonify(notification_stream.recent(current_user, since))
 #this function returns a payload with a list of notifications for the user
 #to not get repeated notis, the user has the option to only request since a given time
 #the since option can be included in the query string of the request URL
+#the page only polls it when the stream below is not available
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notifications_stream():
+    #a Server-Sent Events stream of the notifications of the user, see app/notifications.py
+    if not notification_stream.streaming():
+        return '', 204
+        #a 204 makes the EventSource give up, and the page polls /notifications instead
+    since = request.headers.get('Last-Event-ID', type=float)
+    if since is None:
+        since = request.args.get('since', 0.0, type=float)
+    #a reconnecting EventSource sends the id of the last event it got, the first connection sends since
+    stream = notification_stream.open_stream(current_user, since)
+    if stream is None:
+        return '', 204
+        #this process has as many streams open as it allows, the page polls
+    return current_app.response_class(
+        stream, mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    #X-Accel-Buffering stops nginx from buffering the events
 
 @bp.route('/export_posts')
 @login_required
@@ -290,6 +328,16 @@ def export_posts():
         db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
 
+@bp.route('/export/<token>')
+@login_required
+def download_export(token):
+    #the download link of an archive too big to attach to the export email, see app/export.py
+    path = export.verify_token(token, current_user)
+    if path is None:
+        abort(404)
+        #an invalid or expired link, someone else's archive or one that was already deleted
+    return send_file(path, mimetype='application/gzip', as_attachment=True, download_name=export.FILENAME)
+
 @bp.route('/delete_post/<int:id>', methods=['POST'])
 @login_required
 def delete_post(id):
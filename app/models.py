@@ -15,16 +15,17 @@ from hashlib import md5
 #importing hashlib to generate Gravatar URLs for user avatars
 from time import time 
 import jwt #imports JSON web tokens for password reset functionality
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import query_index, search_page, document, submit, bulk_reindex, count_index_operations
 # we import the search functions defined in app/search.py to integrate full-text search capabilities with our models
 from flask import current_app
 import json
 from time import time 
 import redis 
 import rq
-from flask import url_for
+from flask import url_for, g, has_request_context
 from datetime import timedelta
 import secrets
+from app.pagination import CursorPage, cursor_paginate, offset_paginate
 
 
 
@@ -41,24 +42,33 @@ followers = sa.Table(
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),
               primary_key=True),
     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'),
-              primary_key=True)
+              primary_key=True),
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
+    #the primary key (follower_id, followed_id) answers "who do i follow", this index answers "who follows me"
 )
 
 
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs): #it takes an sql query, a page number and a page size
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, before=None, after=None, count=True, **kwargs): #it takes an sql query, a page number and a page size
         #the to_collection_dict method produces a dictionary with the user collection(collection of user data) representation
         #including the items, _meta and _links sections
-        resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
-        #this obtains a page worth of items
+        if before is not None or after is not None:
+            return cls._to_cursor_collection_dict(query, per_page, endpoint, before, after, **kwargs)
+            #the client asked for keyset pagination by sending a before= or after= cursor (an empty one means the first page)
+        if count:
+            resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
+            #this obtains a page worth of items
+        else:
+            resources = offset_paginate(query, page, per_page)
+            #with count=False the COUNT(*) is skipped and _meta has no total_pages/total_items
+            kwargs['count'] = 0
+            #the links keep count=0 so the client stays in count-free mode
         data = {
-          'items': [item.to_dict() for item in resources.items],
+          'items': cls.to_dict_many(resources.items),
             '_meta': {
                 'page': page,
-                'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total
+                'per_page': per_page
             },
             '_links': {
                 #includes a self reference and links to the next and previous pages
@@ -72,8 +82,36 @@ class PaginatedAPIMixin(object):
                                 **kwargs) if resources.has_prev else None
             }
         }
+        if count:
+            data['_meta']['total_pages'] = resources.pages
+            data['_meta']['total_items'] = resources.total
         return data
 
+    @classmethod
+    def to_dict_many(cls, items):
+        #serializes a page of items, models can override it to share work between the items of the page
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def _to_cursor_collection_dict(cls, query, per_page, endpoint, before, after, **kwargs):
+        #same representation, but the page is found with a cursor on the primary key and there is no COUNT(*),
+        #so _meta has no totals and the _links carry after=/before= cursors instead of page numbers
+        resources = cursor_paginate(query, per_page, (cls.id,), before, after, descending=False)
+        cursor = {'before': before} if before is not None else {'after': after}
+        return {
+            'items': cls.to_dict_many(resources.items),
+            '_meta': {
+                'per_page': per_page
+            },
+            '_links': {
+                'self': url_for(endpoint, per_page=per_page, **cursor, **kwargs),
+                'next': url_for(endpoint, per_page=per_page, **resources.next_args,
+                                **kwargs) if resources.has_next else None,
+                'prev': url_for(endpoint, per_page=per_page, **resources.prev_args,
+                                **kwargs) if resources.has_prev else None
+            }
+        }
+
 #this defines the initial database structure/schema for the application
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     __tablename__ = "user"
@@ -97,6 +135,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: 
                                 datetime.now(timezone.utc))
     #this column stores the last time the user was seen (last active)
+    locale: so.Mapped[Optional[str]] = so.mapped_column(sa.String(10))
+    #the locale of the user's last requests, written with last_seen by app/presence.py
+    #the pre-translation task uses it to know which languages the active users read in
+    num_posts: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_followers: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    num_following: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    #denormalized counters so the profile page, the popup and the API don't run a COUNT(*) for each of them
+    #follow()/unfollow() and the post listener below keep them up to date, "flask counters repair" recomputes them
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
     #this method hashes the given password
@@ -137,48 +183,54 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self._adjust_follow_counts(user, 1)
+            from app import timeline #imported here because app/timeline.py imports this module
+            timeline.follow(self, user)
+            #backfills the recent posts of the followed user into this user's home timeline
     #follow uses add() method of the write-only relationship object 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self._adjust_follow_counts(user, -1)
+            from app import timeline
+            timeline.unfollow(self, user)
+            #prunes the posts of the unfollowed user from this user's home timeline
     #unfollow uses remove() method of the write-only relationship object
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query)
     #this performs a query on the following relationship to see if a given user is already included in it 
     #all write-only relationships have a select() that constructs a query that returns the elements in the relationship
+    def _adjust_follow_counts(self, user, delta):
+        db.session.execute(sa.update(User).where(User.id == self.id).values(
+            num_following=User.num_following + delta))
+        db.session.execute(sa.update(User).where(User.id == user.id).values(
+            num_followers=User.num_followers + delta))
+        #the counters are incremented in SQL so two concurrent follows can't overwrite each other,
+        #SQLAlchemy also applies the change to the objects already loaded in the session
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
-    #in this type of query the results are not returned, but just their count 
-    #the sa.select() specifies the sa.func.count() function from SQL alchemy to indicate that i want to get the result of a function 
-    #select_from() is added with the query that needs to be counted. SQLAlchemy requires the inner query to be converted to a sub-query(.subquery()) 
+        return self.num_followers or 0
+    #the counts are read from the denormalized columns instead of running a COUNT(*) over a subquery
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.num_following or 0
     #same as followers_count
     def following_posts(self):
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
-        #we need the user table twice and SQLAlchemy cant distinguish them so we alias(user User table as two roles)
-        #users are authors of posts and users are followers of other users
+        followed = sa.select(followers.c.followed_id).where(followers.c.follower_id == self.id)
+        #the ids of the users this user follows, read from the (follower_id, followed_id) primary key of the association table
+        authors = sa.union(followed, sa.select(sa.literal(self.id)))
+        #plus the user's own id so their posts are included, the union also removes duplicates
         return (
             sa.select(Post)
             #this defines the entity that needs to be obtained(Post)
-            .join(Post.author.of_type(Author))
-            #this query gives post with its authors info
-            #we join the entries in the posts tables with the Post.author relationship
-            .join(Author.followers.of_type(Follower), isouter=True)
-            #this query gives post with the authors and with the followers
-            #isouter=True makes it a LEFT OUTER JOIN so posts are still included even if an author has no followers
-            .where(sa.or_(Follower.id == self.id, Author.id == self.id))
-            #shows the posts if the current user follows the author or the current user is the author 
-            .group_by(Post)
-            #this removes duplicates(in the case of an author having multiple followers)
+            .where(Post.user_id.in_(authors))
+            #shows the posts whose author is followed by the current user or is the current user
+            #there is no join, so there are no duplicate rows to remove with a GROUP BY
             .order_by(Post.timestamp.desc())
-            #this orders it so it showes the newest post first 
+            #this orders it so it showes the newest post first, the (user_id, timestamp) index on post serves
+            #each author's newest posts in order so the database doesn't have to sort the whole table
+            .options(so.selectinload(Post.author))
+            #_post.html reads post.author, this loads the authors of the whole page with one extra SELECT ... WHERE id IN (...)
+            #instead of one lazy load per post
         )
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode({'reset_password': self.id, 'exp': time() + expires_in},
@@ -205,19 +257,19 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     #this whill have the last time the user visited the messages page
     messages_sent: so.WriteOnlyMapped['Message'] = so.relationship(foreign_keys='Message.sender_id', back_populates='author')
     messages_received: so.WriteOnlyMapped['Message'] = so.relationship(foreign_keys='Message.recipient_id', back_populates='recipient')
+    num_unread_messages: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    #counter of the messages received since last_message_read_time, kept up to date by app/unread.py
     def unread_message_count(self):
-        #uses the last_message_read field to return how many unread messages the user has
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self, Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(query.subquery()))
+        #returns how many unread messages the user has from the cached counter instead of counting the messages
+        from app import unread
+        return unread.get(self)
     notifications: so.WriteOnlyMapped['Notification'] = so.relationship(back_populates='user')
     def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(Notification.name == name))
-        #this adds a notification and if a noti with the same name already exists, it is removed first
-        #the delete() method removes all elements without loading them.
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        from app import notifications
+        return notifications.add(self, name, data)
+        #this sets the notification of that name for the user, replacing the previous value
+        #it is an upsert of one row per (user, name), or a write to the redis hot tier (see app/notifications.py)
+        #either way it is applied by the commit and then pushed to the user's open pages
     tasks: so.WriteOnlyMapped['Task'] = so.relationship(back_populates='user')
     #add a relationship between the user and the task
     def launch_task(self, name, description, *args, **kwargs):
@@ -233,32 +285,58 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         query = self.tasks.select().where(Task.complete == False)
         #we query all tasks for this user and filter to only incomplete tasks and returns them as a list
         return db.session.scalars(query)
+    def get_tasks_progress(self):
+        #returns [(task, progress)] for the tasks in progress, this is what the navbar in base.html shows
+        #the progress of all the tasks is read with one redis round trip (Task.fetch_progress), and kept in g
+        #so the page pays for it once however many times it asks
+        if has_request_context():
+            cache = g.setdefault('tasks_progress', {})
+            if self.id not in cache:
+                cache[self.id] = Task.fetch_progress(self.get_tasks_in_progress().all())
+            return cache[self.id]
+        return Task.fetch_progress(self.get_tasks_in_progress().all())
     def get_task_in_progress(self, name):
         query = self.tasks.select().where(Task.name == name, Task.complete == False)
         #finds a specific task by name if it is still in progress and returns that single task or None
         return db.session.scalar(query)
     def posts_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.posts.select().subquery())
-        return db.session.scalar(query)
+        return self.num_posts or 0
+
+    _LINK_PLACEHOLDER = 918273645
+    #a made up id that is swapped for the real one in the link templates below
+
+    @classmethod
+    def _link_templates(cls):
+        #builds the hypermedia links once with a placeholder id, so a page of users needs 3 url_for calls instead of 3 per user
+        return {name: url_for(endpoint, id=cls._LINK_PLACEHOLDER) for name, endpoint in
+                (('self', 'api.get_user'), ('followers', 'api.get_followers'), ('following', 'api.get_following'))}
+
+    @classmethod
+    def to_dict_many(cls, users, include_email=False):
+        #serializes a whole page of users, used by to_collection_dict()
+        #the counts come from the counter columns, so besides the link templates this runs no queries at all
+        templates = cls._link_templates()
+        return [user.to_dict(include_email, templates) for user in users]
 
-    def to_dict(self, include_email=False):
+    def to_dict(self, include_email=False, link_templates=None):
         #to_dict() converts the user object to a python representaion then to a JSON
         #the current user's dictionary is generated and returned
+        templates = link_templates or self._link_templates()
+        placeholder, user_id = str(self._LINK_PLACEHOLDER), str(self.id)
         data = {
             'id': self.id,
             'username': self.username,
             'last_seen': self.last_seen.replace(
                 tzinfo=timezone.utc).isoformat() if self.last_seen else None, #we use the ISO 8601 format for the date and time fields
             'about_me': self.about_me,
-            'post_count': self.posts_count(), #use helper function above to calculate
-            'follower_count': self.followers_count(), #use helper function above to calculate
-            'following_count': self.following_count(), #use helper function above to calculate
+            'post_count': self.posts_count(), #read from the counter columns
+            'follower_count': self.followers_count(),
+            'following_count': self.following_count(),
             '_links': {
                 #for the hypermedia links, url_for generates urls pointing to the viewfunctions in api/users.py and pass the id arguments
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'following': url_for('api.get_following', id=self.id),
+                'self': templates['self'].replace(placeholder, user_id),
+                'followers': templates['followers'].replace(placeholder, user_id),
+                'following': templates['following'].replace(placeholder, user_id),
                 'avatar': self.avatar(128)
             }
         }
@@ -307,60 +385,100 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 class SearchableMixin(object):
     @classmethod #class method decorator that indicates the method is bound to the class and not the instance
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = query_index(cls.__tablename__, expression, cls.__searchable__, page, per_page)
         #this calls the query_index function defined in app/search.py to perform the search and takes these parameters:
         #cls.__tablename__: the name of the database table associated with the model class
-        if total == 0 or not ids:
-            empty_query = sa.select(cls).where(sa.false())
-            return db.session.scalars(empty_query), 0
-            #if no results are found, return an empty query
-        when = [] #this will hold the ordering conditions
-        for i in range(len(ids)):
-            when.append((ids[i], i)) #this creates a list of tuples mapping each ID to its position in the search results by iterating over the list of IDs and appending a tuple (id, index) to the when list
-        query = sa.select(cls).where(cls.id.in_(ids)).order_by(
-            db.case(*when, value=cls.id))
-        #this constructs a SQLAlchemy query to retrieve the model instances corresponding to the search results
-        #it selects all columns from the model's table where the ID is in the list of IDs returned by the search
-        #the order_by clause uses a CASE statement to preserve the order of the search results based
-        return db.session.scalars(query), total
-    #this executes the constructed query and returns the results as a list of model instances along with the total number of matches found
-    
+        #cls.__searchable__: the fields to search, the other fields of the documents are not matched
+        return cls._hydrate(ids), total
+    #this returns the results as a list of model instances along with the total number of matches found
+
     @classmethod
-    def before_commit(cls, session):
-        session._changes = { #session._changes is a custom attribute added to the session object to track changes made during the session
-            'add': list(session.new), #list of new objects to be added
-            'update': list(session.dirty), #list of modified objects
-            'delete': list(session.deleted) #list of deleted objects
-        }
-    #this method is called before a database commit to track changes made to the session
+    def search_cursor(cls, expression, per_page, before=None, after=None):
+        #cursor based search (app/search.py search_page), returns a page whose items are the model instances
+        #and whose next_args/prev_args hold the cursors for the links, deep pages cost the same as the first
+        page = search_page(cls.__tablename__, expression, cls.__searchable__, per_page, before, after)
+        if page is None:
+            page = CursorPage([], per_page, None, descending=True, backwards=False, from_cursor=False)
+        page.items = cls._hydrate([id for id, _ in page.items])
+        return page
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
+    def _hydrate(cls, ids):
+        #loads the instances for a list of ids and returns them in the same order
+        if not ids:
+            return []
+        query = sa.select(cls).where(cls.id.in_(ids)).options(*[
+            so.selectinload(getattr(cls, rel.key)) for rel in sa.inspect(cls).relationships
+            if rel.lazy != 'write_only'])
+        #this loads every relationship of the results (the author of a post) in bulk, one query per relationship
+        #a '*' wildcard would also reach the write-only collections of the related users, which can't be loaded
+        found = {obj.id: obj for obj in db.session.scalars(query)}
+        return [found[id] for id in ids if id in found]
+        #the primary key lookup comes back in any order, the ranking is restored here in python instead of
+        #an ORDER BY CASE with one branch per id, ids of rows deleted since they were indexed are skipped
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        actions = session.info.setdefault('search_pending', {})
+        #the index actions of the transaction wait in session.info until it commits, they are dropped on rollback
+        #they are keyed by (index, id) so an object changed in several flushes of one commit is sent once
+        skipped = 0
+
+        def add(obj, action):
+            nonlocal skipped
+            key = (obj.__tablename__, obj.id)
+            if actions.pop(key, None) is not None:
+                skipped += 1
+            actions[key] = action
+            #the last change wins and moves to the end, so the actions keep the order of the last changes
+
+        for obj in session.new:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        #this method is called after a database commit to perform any necessary actions based on the changes made during the session
-        for obj in session._changes['update']:
+                add(obj, {'op': 'index', 'index': obj.__tablename__, 'id': obj.id, 'document': document(obj)})
+        #new objects are indexed, the document is built here while the attributes are still loaded,
+        #after the commit they are expired and reading them would cost a query per object
+        for obj in session.dirty:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        #this updates the search index for updated objects
-        for obj in session._changes['delete']:
+                if obj._searchable_changed():
+                    add(obj, {'op': 'index', 'index': obj.__tablename__, 'id': obj.id, 'document': document(obj)})
+                else:
+                    skipped += 1
+        #modified objects are only reindexed when one of their __searchable__ fields changed
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                add(obj, {'op': 'delete', 'index': obj.__tablename__, 'id': obj.id})
         #this removes deleted objects from the search index
-        session._changes = None
-        #clears the tracked changes after processing
+        if skipped:
+            count_index_operations(skipped=skipped)
+
+    def _searchable_changed(self):
+        #looks at the attribute history of the flush, e.g. a change to Post.language alone is not sent
+        attrs = sa.inspect(self).attrs
+        return any(attrs[field].history.has_changes() for field in self.__searchable__)
+
+    @classmethod
+    def after_commit(cls, session):
+        actions = session.info.pop('search_pending', None)
+        if actions:
+            count_index_operations(sent=len(actions))
+            submit(list(actions.values()))
+        #the actions are sent with the bulk API, by a background thread unless SEARCH_INDEX_MODE is 'sync' (app/search.py)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_pending', None)
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__,obj)
+    def reindex(cls, **kwargs):
+        return bulk_reindex(cls, **kwargs)
     #this method reindexes all instances of the model class in the search index
+    #the rows are streamed in id ranges and sent with the bulk API, see "flask search reindex" for the options
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
-#this sets up an event listener that calls the before_commit method of SearchableMixin before a database commit
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+#this sets up an event listener that collects the index changes of SearchableMixin objects every time the session is flushed
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 #this sets up an event listener that calls the after_commit method of SearchableMixin after a database commit
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 class Post(SearchableMixin, db.Model):
     __tablename__ = "post"
@@ -373,8 +491,9 @@ class Post(SearchableMixin, db.Model):
     #this column stores the date and time when the post was created
     #the default value is the current date and time in UTC when the post is created
     #when you pass a function as a default, sa sets the field to the value returned by the function
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     #this column is a foreign key linking to the User model, indicating which user authored the post
+    #it is indexed through ix_post_user_id_timestamp below, which also covers lookups on user_id alone
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     #this sets up a relationship to the User model, allowing access to the author of the post
     #back_populates links this relationship to the 'posts' relationship defined in the User model
@@ -382,9 +501,58 @@ class Post(SearchableMixin, db.Model):
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
     #this column stores the language of the post, represented as a string (e.g., 'en', 'es')
 
+    @staticmethod
+    def update_post_counts(session, flush_context):
+        #keeps User.num_posts in step with the post table, posts added or deleted in this flush are counted per author
+        deltas = {}
+        for obj in session.new:
+            if isinstance(obj, Post):
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+        for user_id, delta in deltas.items():
+            if delta:
+                session.connection().execute(sa.update(User.__table__).where(
+                    User.__table__.c.id == user_id).values(num_posts=User.__table__.c.num_posts + delta))
+                author = session.identity_map.get(so.util.identity_key(User, user_id))
+                if author is not None:
+                    session.expire(author, ['num_posts'])
+                    #the loaded author reloads the new count the next time it is read
+
+    __table_args__ = (
+        sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+    #composite index for "newest posts of these authors", used by User.following_posts() and the user profile page
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
-    
+
+
+class TimelineEntry(db.Model):
+    __tablename__ = "timeline_entry"
+    #this is the database stand-in for the redis home timelines (see app/timeline.py)
+    #each row says "this post is on this user's home timeline", it is a cache so there are no foreign keys,
+    #a row can always be rebuilt from the post and followers tables
+    user_id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    #the owner of the timeline
+    post_id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    author_id: so.Mapped[int] = so.mapped_column(index=True)
+    #the author is stored so an unfollow can prune the posts of one author without a join
+    timestamp: so.Mapped[datetime] = so.mapped_column()
+    #copy of Post.timestamp so the timeline can be read in order without touching the post table
+
+    __table_args__ = (
+        sa.Index('ix_timeline_entry_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+    #one index covers "newest posts on this user's timeline"
+
+    def __repr__(self):
+        return '<TimelineEntry {} {}>'.format(self.user_id, self.post_id)
+
+
+db.event.listen(db.session, 'after_flush', Post.update_post_counts)
+#this updates the post counters of the authors every time posts are written or deleted
 
 @login.user_loader
 def load_user(id):
@@ -407,10 +575,9 @@ class Message(db.Model):
 
 class Notification(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
-    name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                               index=True)
-    timestamp: so.Mapped[float] = so.mapped_column(index=True, default=time)
+    name: so.Mapped[str] = so.mapped_column(sa.String(128))
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
+    timestamp: so.Mapped[float] = so.mapped_column(default=time)
     #timestamp gets its default value from the time.time() function
     payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
     #payload is going to be different for each type of notification, so i write it as a JSON string
@@ -421,6 +588,20 @@ class Notification(db.Model):
         return json.loads(str(self.payload_json))
     #getter function to get the json string file
 
+    __table_args__ = (
+        sa.UniqueConstraint('user_id', 'name', name='uq_notification_user_id_name'),
+    )
+    #one row per notification name per user, written with an upsert (see app/notifications.py)
+    #its index also serves the lookups by user, so the table has no other index to keep up on every write
+
+class Translation(db.Model):
+    #the shared tier of the translation cache in app/translate.py when TRANSLATION_CACHE_BACKEND is 'db'
+    cache_key: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    #sha256 of the text, the source language and the destination language
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
+    #when the translation was stored, so old ones can be deleted
+
 class Task(db.Model):
     #add a task model with columns 
     id: so.Mapped[str] = so.mapped_column(sa.String(36), primary_key=True)
@@ -442,6 +623,29 @@ class Task(db.Model):
         return rq_job
         #other wise return the job object
 
+    @staticmethod
+    def fetch_progress(tasks):
+        #returns [(task, progress)] for a list of tasks, with one Job.fetch_many (a pipeline of HGETALLs)
+        #instead of one Job.fetch round trip per task
+        #the tasks whose job has vanished from redis (expired, or lost with the worker) can never finish,
+        #they are marked complete with one UPDATE and left out
+        if not tasks:
+            return []
+        try:
+            jobs = rq.job.Job.fetch_many([task.id for task in tasks], connection=current_app.redis)
+        except redis.exceptions.RedisError:
+            return [(task, 100) for task in tasks]
+            #if redis is down the progress is unknown, shown as 100 like get_progress() does
+        orphans = [task for task, job in zip(tasks, jobs) if job is None]
+        if orphans:
+            with db.engine.begin() as connection:
+                connection.execute(sa.update(Task).where(Task.id.in_([task.id for task in orphans])).values(
+                    complete=True))
+            #a connection of its own, so rendering a page does not commit the request's session
+            for task in orphans:
+                so.attributes.set_committed_value(task, 'complete', True)
+        return [(task, job.meta.get('progress', 0)) for task, job in zip(tasks, jobs) if job is not None]
+
     def get_progress(self):
         job = self.get_rq_job()
         #we get the result from the above function, if job is None then job expired, then must be complete so we return 100
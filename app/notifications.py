@@ -0,0 +1,262 @@
+import json
+import threading
+from time import monotonic, time
+import redis
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from flask import current_app
+from app import db
+from app.models import Notification
+
+#this file stores the notifications and pushes them to the browser with Server-Sent Events
+#
+#store: there is one notification per (user, name), e.g. the unread message count or the progress of a task,
+#add_notification is called on every message and every progress tick, so it only ever overwrites that one value.
+#NOTIFICATION_BACKEND selects where the live values are kept:
+#'db' upserts the notification row in the request's transaction (one statement, no DELETE + INSERT)
+#'redis' writes the notification:<user_id> hash after the commit and marks the user dirty, the dirty users are
+#written back to the table with one executemany upsert at most every NOTIFICATION_FLUSH_INTERVAL seconds,
+#and /notifications reads the hash, so the table is only a durable copy
+#
+#push: base.html used to poll /notifications?since= every 10 seconds in every open tab, a request and a query even when
+#nothing changed. now each tab keeps one /notifications/stream response open and the notifications are sent
+#as they are committed: User.add_notification -> redis PUBLISH on notifications:<user_id> -> the streams of that user
+#streaming is turned on with NOTIFICATION_STREAM = 'redis', with 'off' the stream answers 204 and the page polls
+#an open stream holds a server thread, so at most NOTIFICATION_STREAM_LIMIT are open per process, the next tabs poll
+#each event id is the notification timestamp, so a reconnecting EventSource sends Last-Event-ID and gets what it missed
+
+DIRTY = 'notification:dirty'
+FLUSH_LOCK = 'notification:flush'
+TTL = 24 * 3600
+#a hash expires a day after its last write, it is loaded again from the table on the next read
+
+
+def channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def key(user_id):
+    return f'notification:{user_id}'
+
+
+def _use_redis():
+    return current_app.config['NOTIFICATION_BACKEND'] == 'redis'
+
+
+def as_dict(notification):
+    return {'name': notification.name, 'data': notification.get_data(), 'timestamp': notification.timestamp}
+
+
+def upsert(connection, rows):
+    #inserts or replaces the notification rows, rows are dicts with user_id, name, timestamp and payload_json
+    #one statement per call, with executemany when there are several rows
+    table = Notification.__table__
+    dialect = connection.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        query = insert.on_conflict_do_update(index_elements=['user_id', 'name'], set_={
+            'timestamp': insert.excluded.timestamp, 'payload_json': insert.excluded.payload_json})
+    elif dialect in ('mysql', 'mariadb'):
+        insert = mysql.insert(table)
+        query = insert.on_duplicate_key_update(timestamp=insert.inserted.timestamp,
+                                               payload_json=insert.inserted.payload_json)
+    else:
+        connection.execute(sa.delete(table).where(
+            table.c.user_id == sa.bindparam('old_user_id'), table.c.name == sa.bindparam('old_name')),
+            [{'old_user_id': row['user_id'], 'old_name': row['name']} for row in rows])
+        query = sa.insert(table)
+        #databases without an upsert statement get the old DELETE + INSERT
+    connection.execute(query, rows)
+
+
+def add(user, name, data):
+    #called by User.add_notification, returns the notification as a dict
+    notification = {'name': name, 'data': data, 'timestamp': time()}
+    if _use_redis():
+        db.session.info.setdefault('notification_writes', []).append((user.id, notification))
+        #like the timeline writes, the hash is written once the transaction commits
+    else:
+        upsert(db.session.connection(), [{'user_id': user.id, 'name': name, 'timestamp': notification['timestamp'],
+                                          'payload_json': json.dumps(data)}])
+    if streaming():
+        db.session.info.setdefault('notifications_pending', []).append((user.id, notification))
+    return notification
+
+
+def _load(user):
+    #fills the hash from the table, HSETNX keeps the values written since the hash expired, returns the merged hash
+    pipe = current_app.redis.pipeline(transaction=False)
+    for notification in db.session.scalars(user.notifications.select()):
+        pipe.hsetnx(key(user.id), notification.name, json.dumps(as_dict(notification)))
+    pipe.hset(key(user.id), '', '')
+    #an empty field marks the hash as loaded, so a user without notifications is not queried again
+    pipe.expire(key(user.id), TTL)
+    pipe.hgetall(key(user.id))
+    return pipe.execute()[-1]
+
+
+def recent(user, since):
+    #returns the notifications of the user newer than the since timestamp, oldest first
+    if not _use_redis():
+        query = user.notifications.select().where(Notification.timestamp > since).order_by(
+            Notification.timestamp.asc())
+        return [as_dict(n) for n in db.session.scalars(query)]
+    try:
+        values = current_app.redis.hgetall(key(user.id))
+        if b'' not in values:
+            values = _load(user)
+        #a hash without the marker is missing or only has the values written since it expired
+        rows = [json.loads(value) for field, value in values.items() if field]
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error reading notifications of user {user.id}: {e}")
+        rows = [as_dict(n) for n in db.session.scalars(user.notifications.select())]
+        #the table can be behind by up to the flush interval, better than no notifications
+    return sorted((n for n in rows if n['timestamp'] > since), key=lambda n: n['timestamp'])
+
+
+def flush():
+    #writes the hashes of the dirty users to the table with one executemany upsert,
+    #returns how many notifications were written
+    rows = []
+    popped = []
+    while True:
+        user_ids = current_app.redis.spop(DIRTY, 1000)
+        if not user_ids:
+            break
+        popped.extend(user_ids)
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(key(int(user_id)))
+        for user_id, values in zip(user_ids, pipe.execute()):
+            for field, value in values.items():
+                if field:
+                    notification = json.loads(value)
+                    rows.append({'user_id': int(user_id), 'name': notification['name'],
+                                 'timestamp': notification['timestamp'],
+                                 'payload_json': json.dumps(notification['data'])})
+    #a user written again after the SPOP is marked dirty again and written by the next flush
+    if rows:
+        try:
+            with db.engine.begin() as connection:
+                upsert(connection, rows)
+            #a connection of its own keeps the write out of the request's session, like presence.flush()
+        except sa.exc.SQLAlchemyError:
+            current_app.redis.sadd(DIRTY, *popped)
+            raise
+            #the users stay dirty for the next flush
+    return len(rows)
+
+
+def event(notification):
+    #formats a notification as a Server-Sent Event
+    return f"id: {notification['timestamp']}\ndata: {json.dumps(notification)}\n\n"
+
+
+def streaming():
+    return current_app.config['NOTIFICATION_STREAM'] == 'redis'
+
+
+class _Slots:
+    #counts the open streams of the process, acquire() returns False when NOTIFICATION_STREAM_LIMIT are open
+    def __init__(self, limit):
+        self.semaphore = threading.BoundedSemaphore(limit) if limit else None
+
+    def acquire(self):
+        return self.semaphore is None or self.semaphore.acquire(blocking=False)
+
+    def release(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
+_slots_lock = threading.Lock()
+
+
+def _get_slots():
+    with _slots_lock:
+        if 'notification_streams' not in current_app.extensions:
+            current_app.extensions['notification_streams'] = _Slots(current_app.config['NOTIFICATION_STREAM_LIMIT'])
+        return current_app.extensions['notification_streams']
+
+
+def open_stream(user, since):
+    #subscribes to the channel of the user and returns the generator of the stream response,
+    #or None when the process already has NOTIFICATION_STREAM_LIMIT streams open, the page then polls
+    #the subscription is made before the missed notifications are read, so nothing committed in between is lost
+    slots = _get_slots()
+    if not slots.acquire():
+        return None
+    try:
+        pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel(user.id))
+        backlog = recent(user, since)
+    except Exception:
+        slots.release()
+        raise
+    db.session.close()
+    #the stream can stay open for minutes, the database connection goes back to the pool now
+    return _stream(pubsub, backlog, since, current_app.config['NOTIFICATION_HEARTBEAT'],
+                   current_app.config['NOTIFICATION_STREAM_TIMEOUT'], slots)
+
+
+def _stream(pubsub, backlog, since, heartbeat, timeout, slots):
+    #runs after the view has returned, so it only uses what it was given, not the app or the database
+    try:
+        yield f'retry: {heartbeat * 1000}\n\n'
+        #how long the browser waits before reconnecting
+        for notification in backlog:
+            since = notification['timestamp']
+            yield event(notification)
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ': heartbeat\n\n'
+                #a comment line, it keeps proxies from closing an idle connection and finds closed tabs
+                continue
+            notification = json.loads(message['data'])
+            if notification['timestamp'] > since:
+                since = notification['timestamp']
+                yield event(notification)
+        #the stream ends after the timeout and the browser reconnects with Last-Event-ID,
+        #so a worker is not held forever by a tab and the connections move to new workers after a deploy
+    except redis.exceptions.RedisError:
+        pass
+        #the browser reconnects, and falls back to polling if the stream can't be opened
+    finally:
+        pubsub.close()
+        slots.release()
+        #runs when the client goes away too, the response iterator is closed
+
+
+def after_commit(session):
+    writes = session.info.pop('notification_writes', None)
+    pending = session.info.pop('notifications_pending', None)
+    if not writes and not pending:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id, notification in writes or []:
+            pipe.hset(key(user_id), notification['name'], json.dumps(notification))
+            pipe.expire(key(user_id), TTL)
+            pipe.sadd(DIRTY, user_id)
+        for user_id, notification in pending or []:
+            pipe.publish(channel(user_id), json.dumps(notification))
+        pipe.execute()
+        if writes and current_app.redis.set(FLUSH_LOCK, 1, nx=True,
+                                            ex=current_app.config['NOTIFICATION_FLUSH_INTERVAL']):
+            flush()
+        #the first commit after the interval writes the dirty users back, like the last_seen buffer
+    except (redis.exceptions.RedisError, sa.exc.SQLAlchemyError) as e:
+        current_app.logger.exception(f"Error writing notifications: {e}")
+        #the open streams miss them, the next reconnect or poll reads them
+
+
+def after_rollback(session):
+    session.info.pop('notification_writes', None)
+    session.info.pop('notifications_pending', None)
+
+
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+#these listeners write and publish the notifications once they are committed, like the ones in app/timeline.py
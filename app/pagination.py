@@ -0,0 +1,124 @@
+import base64
+import json
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from app import db
+
+#this file implements keyset (cursor) pagination
+#db.paginate() uses OFFSET/LIMIT plus a COUNT(*), so page 500 makes the database walk over 499 pages first
+#keyset pagination remembers the sort key of the last row on the page instead, and the next page is
+#"WHERE (timestamp, id) < (last timestamp, last id)", which the index can jump straight to, so every page costs the same
+#the cursors are opaque strings in the before=/after= query arguments:
+#before=<cursor> returns the rows whose key is smaller than the cursor, after=<cursor> the rows whose key is bigger
+#offset_paginate() at the bottom keeps page numbers but also skips the COUNT(*)
+
+
+def encode_cursor(values):
+    #turns the sort key of a row into a url safe string
+    values = [_naive_utc(value).isoformat() if isinstance(value, datetime) else value for value in values]
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_values(cursor):
+    #turns a cursor back into its list of values, returns None if the cursor is missing or was tampered with
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or not all(isinstance(value, (str, int, float)) for value in values):
+        return None
+    return values
+
+
+def decode_cursor(cursor, columns):
+    #turns a cursor back into the sort key values of columns, returns None if it is missing or invalid
+    values = decode_values(cursor)
+    if values is None or len(values) != len(columns):
+        return None
+    try:
+        return tuple(datetime.fromisoformat(value) if isinstance(column.type, sa.DateTime) else value
+                     for column, value in zip(columns, values))
+    except (ValueError, TypeError):
+        return None
+
+
+def _naive_utc(value):
+    #timestamps are stored as naive UTC datetimes, objects that were just created still carry a timezone
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _key(item, columns):
+    return tuple(getattr(item, column.key) for column in columns)
+
+
+def _compare(columns, values, smaller):
+    if len(columns) == 1:
+        return columns[0] < values[0] if smaller else columns[0] > values[0]
+    #row value comparison, (a, b) < (x, y) means a < x or (a = x and b < y)
+    row = sa.tuple_(*columns)
+    return row < values if smaller else row > values
+
+
+class CursorPage:
+    #a page of results with the same items/has_next/has_prev attributes the views use from db.paginate()
+    #next_args and prev_args are the query arguments to pass to url_for() to build the page links
+    def __init__(self, rows, per_page, columns, descending, backwards, from_cursor, key=None):
+        #rows were fetched in scan order with one extra row to find out if there is more past them
+        #backwards is True when the scan went towards the start of the list (the previous page link)
+        #key returns the sort key of a row, by default the values of columns
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+        self.items = rows
+        self.per_page = per_page
+        self.has_next = bool(rows) and (backwards or more)
+        self.has_prev = bool(rows) and (more if backwards else from_cursor)
+        key = key or (lambda row: _key(row, columns))
+        next_name, prev_name = ('before', 'after') if descending else ('after', 'before')
+        self.next_args = {next_name: encode_cursor(key(rows[-1]))} if self.has_next else None
+        self.prev_args = {prev_name: encode_cursor(key(rows[0]))} if self.has_prev else None
+
+
+def cursor_paginate(query, per_page, columns, before=None, after=None, descending=True):
+    #query: a select() statement, any ORDER BY it has is replaced
+    #columns: the sort key, it has to be unique so the primary key goes last, e.g. (Post.timestamp, Post.id)
+    #descending: newest first lists (timelines) go down the key, the next page is before= the last row
+    #before/after: the raw cursors from the request, an empty or invalid cursor returns the first page
+    before_key = decode_cursor(before, columns)
+    after_key = None if before_key is not None else decode_cursor(after, columns)
+    if before_key is not None:
+        query = query.where(_compare(columns, before_key, smaller=True))
+    elif after_key is not None:
+        query = query.where(_compare(columns, after_key, smaller=False))
+    backwards = (after_key if descending else before_key) is not None
+    scan_down = descending != backwards
+    query = query.order_by(None).order_by(*[c.desc() if scan_down else c.asc() for c in columns])
+    rows = list(db.session.scalars(query.limit(per_page + 1)))
+    return CursorPage(rows, per_page, columns, descending, backwards,
+                      before_key is not None or after_key is not None)
+
+
+class OffsetPage:
+    #a page number based page that was found without counting, so there is no total or pages attribute
+    def __init__(self, rows, page, per_page):
+        self.items = rows[:per_page]
+        self.page = page
+        self.per_page = per_page
+        self.has_next = len(rows) > per_page
+        self.has_prev = page > 1
+        self.next_num = page + 1 if self.has_next else None
+        self.prev_num = page - 1 if self.has_prev else None
+
+
+def offset_paginate(query, page, per_page):
+    #same OFFSET/LIMIT paging as db.paginate() but without the COUNT(*) query
+    #it fetches one row more than the page holds, if that row exists there is a next page
+    page = max(page, 1)
+    rows = list(db.session.scalars(query.limit(per_page + 1).offset((page - 1) * per_page)))
+    return OffsetPage(rows, page, per_page)
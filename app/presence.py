@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import datetime, timezone
+import redis
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+from app import db
+from app.models import User
+
+#this file buffers the User.last_seen updates
+#main.before_request used to set last_seen and commit on every request, a write transaction per page view
+#now the time is recorded in a buffer and the buffered times are written with one bulk UPDATE every
+#LAST_SEEN_FLUSH_INTERVAL seconds (or by "flask last-seen flush"), so most page views don't write to the database
+#there are two buffers, selected with the LAST_SEEN_BACKEND config variable:
+#'redis' keeps one hash shared by all the processes, 'memory' keeps a dict per process (tests and setups without redis)
+#last_seen is only shown with minute precision, a few seconds of delay (or a lost buffer on a crash) is fine
+#the locale of the request is buffered and written with the time, so User.locale tells which languages the users read in
+
+
+class MemoryBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.flushed_at = time.time()
+
+    def record(self, user_id, timestamp, locale=None):
+        with self.lock:
+            self.times[user_id] = (timestamp, locale)
+
+    def claim(self, interval):
+        #returns True when this caller should flush, at most once every interval seconds
+        with self.lock:
+            if time.time() - self.flushed_at < interval:
+                return False
+            self.flushed_at = time.time()
+            return True
+
+    def drain(self):
+        #takes every buffered time out of the buffer
+        with self.lock:
+            times, self.times = self.times, {}
+        return times
+
+
+class RedisBuffer:
+    KEY = 'last_seen'
+    LOCK = 'last_seen:flush'
+
+    def __init__(self, connection):
+        self.redis = connection
+
+    def record(self, user_id, timestamp, locale=None):
+        self.redis.hset(self.KEY, user_id, f'{timestamp} {locale or ""}'.rstrip())
+        #the value is "<timestamp> <locale>", the locale is left out when it is not known
+
+    def claim(self, interval):
+        #the first process to create the lock key flushes, the key expires after the interval
+        return bool(self.redis.set(self.LOCK, 1, ex=max(int(interval), 1), nx=True))
+
+    def drain(self):
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.KEY)
+        pipe.delete(self.KEY)
+        times, _ = pipe.execute()
+        #MULTI/EXEC makes read and delete atomic, times recorded in between go to a new hash
+        return {int(user_id): _parse(value) for user_id, value in times.items()}
+
+
+def _parse(value):
+    timestamp, _, locale = value.decode('utf-8').partition(' ')
+    return float(timestamp), locale or None
+
+
+def get_buffer():
+    #returns the buffer selected by the LAST_SEEN_BACKEND config variable
+    if current_app.config['LAST_SEEN_BACKEND'] == 'redis':
+        return RedisBuffer(current_app.redis)
+    return current_app.extensions.setdefault('last_seen', MemoryBuffer())
+    #the memory buffer is stored on the app so every app instance (e.g. in tests) has its own
+
+
+def touch(user, locale=None):
+    #called by main.before_request instead of setting last_seen and committing
+    now = datetime.now(timezone.utc)
+    so.attributes.set_committed_value(user, 'last_seen', now)
+    #the loaded user shows the new time for the rest of the request without becoming dirty
+    buffer = get_buffer()
+    try:
+        buffer.record(user.id, now.timestamp(), locale)
+        if buffer.claim(current_app.config['LAST_SEEN_FLUSH_INTERVAL']):
+            flush(buffer)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error buffering last_seen of user {user.id}: {e}")
+
+
+def flush(buffer=None):
+    #writes the buffered times and locales with a single executemany UPDATE and returns how many users were updated
+    buffer = buffer or get_buffer()
+    times = buffer.drain()
+    if not times:
+        return 0
+    user = User.__table__
+    query = sa.update(user).where(user.c.id == sa.bindparam('user_id')).values(
+        last_seen=sa.bindparam('seen'), locale=sa.func.coalesce(sa.bindparam('locale'), user.c.locale))
+    #coalesce keeps the stored locale when the buffer didn't have one
+    with db.engine.begin() as connection:
+        connection.execute(query, [
+            {'user_id': user_id, 'seen': datetime.fromtimestamp(timestamp, timezone.utc), 'locale': locale}
+            for user_id, (timestamp, locale) in times.items()])
+    #a connection of its own keeps the write out of the request's session and its commit listeners
+    return len(times)
@@ -0,0 +1,64 @@
+from time import monotonic
+from flask import current_app
+from rq import get_current_job
+from app import db
+from app.models import Task
+
+#this file reports the progress of the background tasks in app/tasks.py
+#tasks.export_posts used to report after every post: save the job meta to redis, load the Task, add_notification
+#and commit, so an export of 50k posts made 50k transactions and 50k redis writes for a number shown as a percentage
+#ProgressReporter only sends an update when the percentage moved by TASK_PROGRESS_STEP points, or by any amount
+#after TASK_PROGRESS_INTERVAL seconds, so a task sends about 100 / step + duration / interval updates at most
+
+
+class ProgressReporter:
+    #usage in a task:
+    #    progress = ProgressReporter(total)
+    #    for i, item in enumerate(items, 1):
+    #        ...
+    #        progress.update(i)
+    #    progress.finish()    (in a finally block, so the task is never left in progress)
+    def __init__(self, total=0, interval=None, step=None, job=None):
+        self.total = total
+        self.interval = current_app.config['TASK_PROGRESS_INTERVAL'] if interval is None else interval
+        self.step = current_app.config['TASK_PROGRESS_STEP'] if step is None else step
+        self.job = job or get_current_job()
+        #None when the function is called outside a worker, then nothing is reported
+        self.sent = None
+        self.sent_at = 0.0
+        self.reports = 0
+
+    def update(self, done):
+        #called with the number of items done so far, as often as the task likes
+        progress = min(100 * done // self.total if self.total else 0, 99)
+        #100 is only sent by finish(), the task may still have work to do after its last item (e.g. send an email)
+        if self.sent is not None:
+            if progress <= self.sent:
+                return
+            if progress - self.sent < self.step and monotonic() - self.sent_at < self.interval:
+                return
+        self.report(progress)
+
+    def finish(self):
+        #reports 100, which marks the task complete, unless it was already sent
+        if self.sent != 100:
+            self.report(100)
+
+    def report(self, progress):
+        #sends the progress: the job meta, the task row and the user's notification, in one commit
+        self.sent = progress
+        self.sent_at = monotonic()
+        self.reports += 1
+        if self.job is None:
+            return
+        self.job.meta['progress'] = progress
+        self.job.save_meta()
+        #store progess in redis, read by Task.get_progress()
+        task = db.session.get(Task, self.job.get_id())
+        if task is None:
+            return
+        task.user.add_notification('task_progress', {'task_id': task.id, 'progress': progress})
+        #we send a notification to the user
+        if progress >= 100:
+            task.complete = True
+        db.session.commit()
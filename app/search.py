@@ -1,43 +1,649 @@
+import atexit
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from elasticsearch import ApiError, TransportError
+import redis
+import sqlalchemy as sa
 from flask import current_app
+from app import db
+from app.pagination import CursorPage, decode_values
+
+#this file is the only place that talks to the search engine, the rest of the app uses the functions below
+#there are two backends with the same methods, selected with the SEARCH_BACKEND config variable:
+#ElasticsearchBackend uses the cluster in app.elasticsearch
+#FTSBackend keeps an SQLite FTS5 table per index in its own database file (SEARCH_FTS_URL) and ranks with BM25,
+#so single server setups and the tests get full-text search without running Elasticsearch
+#a backend's send() applies a list of actions, {'op': 'index' or 'delete', 'index', 'id', 'document'},
+#and returns the ones that failed for a reason worth retrying (overloaded or unreachable engine)
+#the queries are given the fields to search, the __searchable__ fields of the model (SearchableMixin)
+
+
+class ElasticsearchBackend:
+    RETRY_STATUS = {429, 502, 503, 504}
+    #bulk items failing with these statuses (overloaded or restarting cluster) are tried again
+
+    def send(self, actions, refresh=False):
+        operations = []
+        for action in actions:
+            operations.append({action['op']: {'_index': action['index'], '_id': action['id']}})
+            if action['op'] == 'index':
+                operations.append(dict(action['document'], id=action['id']))
+                #the id is also a field of the document, query_page sorts on it to break ties between equal scores
+        kwargs = {'refresh': 'wait_for'} if refresh else {}
+        #with refresh the request waits until the changes are visible to search, so the result cache is not refilled
+        #with results that miss them (the request only blocks in sync mode, the queue thread sends the batches
+        #otherwise). only the commits ask for it, the reindex ranges don't wait for a refresh each
+        try:
+            response = current_app.elasticsearch.bulk(operations=operations, **kwargs)
+        except (ApiError, TransportError) as e:
+            status = getattr(e, 'status_code', None)
+            if status is not None and status not in self.RETRY_STATUS:
+                current_app.logger.exception(f"Bulk indexing rejected by Elasticsearch: {e}")
+                return []
+            current_app.logger.warning(f"Bulk indexing failed: {e}")
+            return actions
+            #the whole batch is retried when the cluster can't be reached
+        failed = []
+        for action, item in zip(actions, response.body['items']):
+            result = item[action['op']]
+            status = result.get('status', 200)
+            if status in self.RETRY_STATUS:
+                failed.append(action)
+            elif status >= 300 and not (action['op'] == 'delete' and status == 404):
+                current_app.logger.error(f"Error indexing document {action['id']} in {action['index']}: "
+                                         f"{result.get('error')}")
+            #deleting a document that was never indexed is not an error
+        return failed
+
+    def query(self, index, query, fields, page, per_page):
+        try:
+            search = current_app.elasticsearch.search(
+                index=index,
+                query={
+                    'multi_match': {'query': query, 'fields': list(fields)}
+                }, #search query to match the query string against the searchable fields
+                from_=(page - 1) * per_page, #pagination: starting point
+                size=per_page #number of results to return
+            )
+        except Exception as e:
+            current_app.logger.exception(f"Error querying Elasticsearch: {e}")
+            return [], 0
+        res = search.body
+        ids = [int(hit['_id']) for hit in res['hits']['hits']] #extract the IDs of the matching documents using comprehension which iterates over the search hits and collects the _id field from each hit
+        total = res['hits']['total']['value'] #get the total number of matches
+        return ids, total
+
+    def query_page(self, index, query, fields, size, position=None, backwards=False):
+        #one page of (id, sort key) hits in relevance order, continuing after position with search_after
+        #the key is (_score, id), the id field breaks the ties so the order is the same on every page
+        #there is no point in time (PIT): one per search would stay open for its keep-alive and a busy search page
+        #would reach the limit of open PITs of the cluster, so hits written between two pages can shift them
+        if position is not None and (len(position) != 2 or
+                                     not all(isinstance(value, (int, float)) for value in position)):
+            position = None
+        order = 'asc' if backwards else 'desc'
+        kwargs = {'search_after': position} if position else {}
+        try:
+            res = current_app.elasticsearch.search(
+                index=index,
+                query={'multi_match': {'query': query, 'fields': list(fields)}},
+                #only the searchable fields, the id field is there for sorting, a query like "42" must not match it
+                sort=[{'_score': order}, {'id': {'order': order, 'unmapped_type': 'long'}}],
+                size=size, track_total_hits=False, **kwargs).body
+        except Exception as e:
+            current_app.logger.exception(f"Error querying Elasticsearch: {e}")
+            return []
+        return [(int(hit['_id']), hit['sort']) for hit in res['hits']['hits']]
+        #documents indexed before the id field existed sort last among equal scores until the next reindex
+
+    def create_index(self, name):
+        current_app.elasticsearch.indices.create(index=name)
+
+    def swap_alias(self, alias, target):
+        #points alias at target in one atomic call and deletes the indexes it pointed at before
+        es = current_app.elasticsearch
+        actions = [{'add': {'index': target, 'alias': alias}}]
+        old = []
+        if es.indices.exists_alias(name=alias):
+            old = [name for name in es.indices.get_alias(name=alias).body if name != target]
+            actions = [{'remove': {'index': name, 'alias': alias}} for name in old] + actions
+        elif es.indices.exists(index=alias):
+            actions = [{'remove_index': {'index': alias}}] + actions
+            #the first time, the alias replaces the concrete index that had its name
+        es.indices.update_aliases(actions=actions)
+        for name in old:
+            es.indices.delete(index=name)
+
+    def after_fork(self):
+        from app import connect_elasticsearch
+        current_app.elasticsearch = connect_elasticsearch()
+        #the connections of the parent process can't be shared
+
+
+class FTSBackend:
+    TOKENIZER = 'unicode61 remove_diacritics 2'
+    #splits on unicode word boundaries and folds accents, posts are written in many languages so there is no stemming
+
+    def __init__(self, url):
+        kwargs = {}
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            kwargs = {'poolclass': sa.pool.StaticPool, 'connect_args': {'check_same_thread': False}}
+            #an in-memory database only lives as long as its connection, so every thread shares the one connection
+        self.engine = sa.create_engine(url, **kwargs)
+        self.tables = set()
+
+    @staticmethod
+    def _quote(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def _exists(self, connection, name):
+        if name not in self.tables and connection.execute(sa.text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': name}).first():
+            self.tables.add(name)
+        return name in self.tables
+
+    def _create(self, connection, name, fields):
+        #the table is created with the fields of the first document written to it
+        columns = ', '.join(self._quote(field) for field in fields)
+        connection.execute(sa.text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self._quote(name)} USING fts5({columns}, tokenize='{self.TOKENIZER}')"))
+        self.tables.add(name)
+
+    def send(self, actions, refresh=False):
+        #consecutive actions of the same kind on the same table are written with one executemany
+        runs = []
+        for action in actions:
+            kind = (action['op'], action['index'], tuple(action.get('document', ())))
+            if runs and runs[-1][0] == kind:
+                runs[-1][1].append(action)
+            else:
+                runs.append((kind, [action]))
+        try:
+            with self.engine.begin() as connection:
+                for (op, index, fields), run in runs:
+                    table = self._quote(index)
+                    if op == 'delete':
+                        if self._exists(connection, index):
+                            connection.execute(sa.text(f'DELETE FROM {table} WHERE rowid = :id'),
+                                               [{'id': action['id']} for action in run])
+                        continue
+                    if not self._exists(connection, index):
+                        self._create(connection, index, fields)
+                    columns = ', '.join(self._quote(field) for field in fields)
+                    values = ', '.join(f':f{i}' for i in range(len(fields)))
+                    connection.execute(
+                        sa.text(f'INSERT OR REPLACE INTO {table}(rowid, {columns}) VALUES (:id, {values})'),
+                        [{'id': action['id'], **{f'f{i}': action['document'][field] or ''
+                                                 for i, field in enumerate(fields)}} for action in run])
+        except sa.exc.OperationalError as e:
+            current_app.logger.warning(f"Full-text indexing failed: {e}")
+            self.tables.clear()
+            return actions
+            #"database is locked" when another process is writing, the batch is retried
+        return []
+
+    @staticmethod
+    def _match(query):
+        words = re.findall(r'\w+', query)
+        if not words:
+            return None
+        return ' OR '.join(f'"{word}"' for word in words)
+        #every word is quoted so the query syntax of FTS5 (AND, NOT, -, *) in user input is searched as plain text,
+        #OR matches any word like the multi_match query of Elasticsearch
+
+    def query(self, index, query, fields, page, per_page):
+        match = self._match(query)
+        if match is None:
+            return [], 0
+        table = self._quote(index)
+        with self.engine.connect() as connection:
+            if not self._exists(connection, index):
+                return [], 0
+            ids = list(connection.execute(sa.text(
+                f'SELECT rowid FROM {table} WHERE {table} MATCH :match ORDER BY bm25({table}), rowid DESC '
+                f'LIMIT :limit OFFSET :offset'),
+                {'match': match, 'limit': per_page, 'offset': (page - 1) * per_page}).scalars())
+            #bm25() is smaller for better matches, newer posts come first among equal scores
+            total = connection.execute(sa.text(f'SELECT count(*) FROM {table} WHERE {table} MATCH :match'),
+                                       {'match': match}).scalar()
+        return ids, total
+
+    def query_page(self, index, query, fields, size, position=None, backwards=False):
+        #one page of (id, sort key) hits in relevance order, the key is (bm25 score, rowid)
+        #the table only has the searchable fields, so the whole row is searched
+        match = self._match(query)
+        table = self._quote(index)
+        rank = f'bm25({table})'
+        if match is None:
+            return []
+        if position is not None and (len(position) != 2 or
+                                     not all(isinstance(value, (int, float)) for value in position)):
+            position = None
+        condition, order = '', f'{rank}, rowid DESC'
+        if backwards:
+            order = f'{rank} DESC, rowid ASC'
+        if position is not None:
+            condition = (f'AND ({rank} < :score OR ({rank} = :score AND rowid > :id))' if backwards else
+                         f'AND ({rank} > :score OR ({rank} = :score AND rowid < :id))')
+        with self.engine.connect() as connection:
+            if not self._exists(connection, index):
+                return []
+            rows = connection.execute(sa.text(
+                f'SELECT rowid, {rank} FROM {table} WHERE {table} MATCH :match {condition} '
+                f'ORDER BY {order} LIMIT :limit'),
+                {'match': match, 'limit': size, 'score': position and position[0], 'id': position and position[1]})
+            return [(rowid, [score, rowid]) for rowid, score in rows]
+
+    def create_index(self, name):
+        pass
+        #the table is created when the first document is written to it
+
+    def swap_alias(self, alias, target):
+        #sqlite has no aliases, the new table takes the name of the old one in a single transaction
+        with self.engine.begin() as connection:
+            connection.execute(sa.text(f'DROP TABLE IF EXISTS {self._quote(alias)}'))
+            if self._exists(connection, target):
+                connection.execute(sa.text(f'ALTER TABLE {self._quote(target)} RENAME TO {self._quote(alias)}'))
+        self.tables.clear()
+
+    def after_fork(self):
+        self.engine.dispose(close=False)
+
+
+def get_backend():
+    #returns the backend selected by the SEARCH_BACKEND config variable, None when search is turned off
+    name = current_app.config['SEARCH_BACKEND']
+    if name == 'elasticsearch':
+        return ElasticsearchBackend() if current_app.elasticsearch else None
+    if name == 'fts':
+        if 'search_fts' not in current_app.extensions:
+            current_app.extensions['search_fts'] = FTSBackend(current_app.config['SEARCH_FTS_URL'])
+        return current_app.extensions['search_fts']
+    return None
+
 
 def add_to_index(index, model):
-    #this function adds a model instance to the specified Elasticsearch index
-    if not current_app.elasticsearch:
-        return
-    payload = {} #this will hold the data to be indexed
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field) #get the value of each searchable field from the model instance
-    try:
-        current_app.elasticsearch.index(index=index, id=model.id, document=payload) #index the document in Elasticsearch
-    except Exception as e:
-        current_app.logger.exception(f"Error indexing document {model.id} in Elasticsearch: {e}")
+    #this function adds a model instance to the specified search index right away
+    bulk([{'op': 'index', 'index': index, 'id': model.id, 'document': document(model)}], refresh=True)
+
 
 def remove_from_index(index, model):
-    #this function removes a model instance from the specified Elasticsearch index
-    if not current_app.elasticsearch:
+    #this function removes a model instance from the specified search index right away
+    bulk([{'op': 'delete', 'index': index, 'id': model.id}], refresh=True)
+
+
+def query_index(index, query, fields, page, per_page):
+    #this function performs a search query on the specified index and returns the ids of a page and the total
+    #fields are the fields to search, the __searchable__ fields of the model
+    backend = get_backend()
+    if backend is None:
+        return [], 0 #if search is not configured, return empty results
+    cache = get_cache()
+    key = cache.key(index, query, page, per_page) if cache else None
+    if key is not None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+    ids, total = backend.query(index, query, fields, page, per_page)
+    if key is not None:
+        cache.put(key, (ids, total))
+    return ids, total
+
+
+def search_page(index, query, fields, per_page, before=None, after=None):
+    #cursor based search, returns a CursorPage of (id, sort key) hits or None when search is not configured
+    #the hits are in relevance order, before=<cursor> gives the next page (less relevant hits), after=<cursor> the
+    #previous one, the same names the other lists use so the views build the links the same way
+    #unlike query_index() there is no OFFSET, so deep pages cost the same as the first and have no 10k hit limit
+    backend = get_backend()
+    if backend is None:
+        return None
+    position = decode_values(before)
+    backwards = position is None and decode_values(after) is not None
+    if backwards:
+        position = decode_values(after)
+    cache = get_cache()
+    key = cache.key(index, query, 'cursor', tuple(position or ()), backwards, per_page) if cache else None
+    rows = cache.get(key) if key is not None else None
+    if rows is None:
+        rows = backend.query_page(index, query, fields, per_page + 1, position, backwards)
+        if key is not None:
+            cache.put(key, rows)
+    #the pages are cached like the results of query_index(), by cursor instead of page number
+    return CursorPage(rows, per_page, None, descending=True, backwards=backwards,
+                      from_cursor=position is not None, key=lambda row: row[1])
+
+
+#the search results are cached in each process, (index, generation, query, page, per_page) -> (ids, total)
+#and (index, generation, query, 'cursor', position, backwards, per_page) -> hits for the pages of search_page()
+#every index has a generation number that goes up each time documents are written to it (bulk() below),
+#so a cached result is never used after the index changed and the TTL can be long
+#the generations are kept in redis when SEARCH_GENERATION_BACKEND is 'redis' so a write seen by one process
+#invalidates the results cached by all of them, with 'memory' (tests) they are per process
+
+
+class ResultCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.hits = self.misses = 0
+
+    def generation(self, index):
+        if current_app.config['SEARCH_GENERATION_BACKEND'] == 'redis':
+            return int(current_app.redis.get(f'search:generation:{index}') or 0)
+        return self.generations.get(index, 0)
+
+    def bump(self, indexes):
+        if current_app.config['SEARCH_GENERATION_BACKEND'] == 'redis':
+            pipe = current_app.redis.pipeline(transaction=False)
+            for index in indexes:
+                pipe.incr(f'search:generation:{index}')
+            pipe.execute()
+            return
+        with self.lock:
+            for index in indexes:
+                self.generations[index] = self.generations.get(index, 0) + 1
+
+    def key(self, index, query, *args):
+        #returns None when the generation can't be read, the search then skips the cache
+        try:
+            generation = self.generation(index)
+        except redis.exceptions.RedisError as e:
+            current_app.logger.warning(f"Search cache disabled, can't read the index generation: {e}")
+            return None
+        return (index, generation, ' '.join(query.lower().split())) + args
+        #queries that only differ in case or spacing share an entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            #the least recently used entries go first, including the ones of older generations
+
+
+def get_cache():
+    #one cache per app, None when SEARCH_CACHE_SIZE is 0
+    if not current_app.config['SEARCH_CACHE_SIZE']:
+        return None
+    if 'search_cache' not in current_app.extensions:
+        current_app.extensions['search_cache'] = ResultCache(current_app.config['SEARCH_CACHE_SIZE'],
+                                                             current_app.config['SEARCH_CACHE_TTL'])
+    return current_app.extensions['search_cache']
+
+
+#the functions below send index changes in batches (the Elasticsearch bulk API) instead of one request per document
+#SearchableMixin collects the changes of a commit as actions, {'op': 'index' or 'delete', 'index', 'id', 'document'},
+#and hands them to submit() after the commit
+#with SEARCH_INDEX_MODE = 'async' they go to a queue that a background thread sends in batches, so a slow or
+#unreachable cluster no longer slows down the request that wrote the post, 'sync' sends them right away (tests)
+
+def document(model):
+    #the searchable fields of a model instance, the body of its Elasticsearch document
+    return {field: getattr(model, field) for field in model.__searchable__}
+
+
+def _collapse(actions):
+    #keeps only the last action of each document, in the order of those last actions
+    #an index followed by a delete of the same post must not be sent the other way round,
+    #and one bulk request can't be relied on to apply two actions on the same id in order once items are retried
+    latest = {}
+    for action in actions:
+        key = (action['index'], action['id'])
+        latest.pop(key, None)
+        latest[key] = action
+    return list(latest.values())
+
+
+def bulk(actions, refresh=False):
+    #sends the actions to the search backend, retrying the failed ones with exponential backoff
+    #refresh waits until they are visible to search before the cached results are invalidated, for the commits
+    #returns how many actions could not be applied
+    backend = get_backend()
+    if backend is None or not actions:
+        return 0
+    pending = _collapse(actions)
+    retries = current_app.config['SEARCH_BULK_RETRIES']
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(current_app.config['SEARCH_BULK_BACKOFF'] * 2 ** (attempt - 1))
+            pending = backend.send(pending, refresh)
+            if not pending:
+                return 0
+        current_app.logger.error(f"Gave up indexing {len(pending)} documents after {retries + 1} attempts")
+        return len(pending)
+    finally:
+        _invalidate({action['index'] for action in actions})
+        #the cached results of the changed indexes are dropped once the changes are searchable
+
+
+def _invalidate(indexes):
+    cache = get_cache()
+    if cache is None:
         return
     try:
-        current_app.elasticsearch.delete(index=index, id=model.id)
-    except Exception as e:
-        current_app.logger.exception(f"Error removing document {model.id} from Elasticsearch: {e}") #delete the document from Elasticsearch
-
-def query_index(index, query, page, per_page):
-    #this function performs a search query on the specified Elasticsearch index
-    if not current_app.elasticsearch:
-        return [], 0 #if Elasticsearch is not configured, return empty results
+        cache.bump(indexes)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error invalidating the search cache: {e}")
+
+
+class IndexQueue:
+    #an in-process queue of index actions, a daemon thread takes them off in batches and sends them with bulk()
+    #there is a single sending thread so the actions of one process reach Elasticsearch in commit order
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='search-indexer', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+        #actions still in the queue are sent when the process exits normally
+
+    def put(self, actions):
+        for action in actions:
+            self.queue.put(action)
+
+    def run(self):
+        size = self.app.config['SEARCH_BULK_SIZE']
+        interval = self.app.config['SEARCH_BULK_INTERVAL']
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + interval
+            #waits a little for more actions so a burst of commits goes out in one request
+            while len(batch) < size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    bulk(batch, refresh=True)
+            except Exception as e:
+                self.app.logger.exception(f"Error in the search indexer: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        #blocks until every queued action has been sent
+        self.queue.join()
+
+
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    #one queue per app, started on first use
+    with _queue_lock:
+        if 'search_index_queue' not in current_app.extensions:
+            current_app.extensions['search_index_queue'] = IndexQueue(current_app._get_current_object())
+        return current_app.extensions['search_index_queue']
+
+
+def count_index_operations(sent=0, skipped=0):
+    #counts the index actions SearchableMixin sent and the ones it skipped (no searchable field changed, or a
+    #second change to the same object in one commit), per process
+    stats = current_app.extensions.setdefault('search_index_stats', collections.Counter())
+    stats.update(sent=sent, skipped=skipped)
+
+
+def index_stats():
+    #returns {'sent': n, 'skipped': n} for this process
+    stats = current_app.extensions.get('search_index_stats', {})
+    return {'sent': stats.get('sent', 0), 'skipped': stats.get('skipped', 0)}
+
+
+def submit(actions):
+    #called by SearchableMixin.after_commit with the actions of the commit
+    if get_backend() is None or not actions:
+        return
+    if current_app.config['SEARCH_INDEX_MODE'] == 'sync':
+        bulk(actions, refresh=True)
+    else:
+        get_queue().put(actions)
+
+
+#the functions below rebuild a whole index for "flask search reindex"
+#the rows are read in id ranges of chunk_size ids, only the id and searchable columns are selected so no model
+#objects are created, each range is sent with one bulk request and the ranges are spread over a pool of processes
+#the progress is saved to a state file after every range, so an interrupted reindex can carry on with --resume
+
+_worker_app = None
+
+
+def _init_worker():
+    #runs in each forked worker process, the database and search connections of the parent can't be shared
+    _worker_app.app_context().push()
+    db.engine.dispose(close=False)
+    get_backend().after_fork()
+
+
+def _index_range(task):
+    #indexes the rows of model with lo <= id < hi into target, returns (lo, hi, rows, failed)
+    model, target, lo, hi = task
+    columns = [getattr(model, field) for field in model.__searchable__]
+    rows = db.session.execute(sa.select(model.id, *columns).where(model.id >= lo, model.id < hi)).all()
+    db.session.rollback()
+    #ends the read transaction, nothing is kept in the session between ranges
+    actions = [{'op': 'index', 'index': target, 'id': row[0],
+                'document': dict(zip(model.__searchable__, row[1:]))} for row in rows]
+    return lo, hi, len(rows), bulk(actions)
+
+
+def _read_state(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_state(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+    #the state file is replaced in one step so it is never left half written
+
+
+def bulk_reindex(model, chunk_size=10000, workers=4, new_index=False, resume=False, state_path=None,
+                 progress=None):
+    #rebuilds the index of model, progress(rows, elapsed) is called after every range
+    #returns a dict with the target index and the number of rows, failed documents and seconds
+    global _worker_app
+    if get_backend() is None:
+        raise ValueError('search is not configured')
+    index = model.__tablename__
+    state_path = state_path or f'reindex-{index}.json'
+    state = _read_state(state_path) if resume else None
+    if resume and state is None:
+        raise ValueError(f'no reindex of {index} to resume, {state_path} does not exist')
+    if state is None:
+        target = f'{index}-{int(time.time())}' if new_index else index
+        if new_index:
+            get_backend().create_index(target)
+        state = {'index': index, 'target': target, 'swap': new_index, 'done': None, 'retry': []}
+        _write_state(state_path, state)
+    target = state['target']
+
+    low, high = db.session.execute(sa.select(sa.func.min(model.id), sa.func.max(model.id))).one()
+    db.session.rollback()
+    start = state['done'] if state['done'] is not None else (low or 0)
+    retry = state.get('retry', [])
+    state['retry'] = []
+    ranges = [(model, target, lo, hi) for lo, hi in retry] + \
+        [(model, target, lo, lo + chunk_size) for lo in range(start, (high or 0) + 1, chunk_size)]
+    #the ranges that had failed documents in the last run are sent again first
+
+    rows = failed = 0
+    finished = set()
+    started = time.perf_counter()
+    if workers > 1:
+        _worker_app = current_app._get_current_object()
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker)
+        results = pool.imap_unordered(_index_range, ranges)
+    else:
+        pool = None
+        results = map(_index_range, ranges)
+        #without workers the ranges are indexed in this process, one after the other
     try:
-        search = current_app.elasticsearch.search(
-            index=index,
-            query={
-                'multi_match': {'query': query, 'fields': ['*']}
-            }, #search query to match the query string against all fields
-            from_=(page - 1) * per_page, #pagination: starting point
-            size=per_page #number of results to return
-        )
-    except Exception as e:
-        current_app.logger.exception(f"Error querying Elasticsearch: {e}")
-        return [], 0
-    res = search.body
-    ids = [int(hit['_id']) for hit in res['hits']['hits']] #extract the IDs of the matching documents using comprehension which iterates over the search hits and collects the _id field from each hit
-    total = res['hits']['total']['value'] #get the total number of matches
-    return ids, total
+        for lo, hi, count, errors in results:
+            rows += count
+            failed += errors
+            if errors:
+                state['retry'].append([lo, hi])
+                #the position moves on, and the range is kept in the state file so --resume sends it again
+            if [lo, hi] not in retry:
+                finished.add(lo)
+            while start in finished:
+                finished.discard(start)
+                start += chunk_size
+            #the saved position only moves past ranges that are all done, the pool finishes them out of order
+            state['done'] = start
+            _write_state(state_path, state)
+            if progress:
+                progress(rows, time.perf_counter() - started)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if state['swap'] and not state['retry']:
+        new_rows = _index_range((model, target, (high or 0) + 1, 2 ** 62))
+        rows += new_rows[2]
+        failed += new_rows[3]
+        if new_rows[3]:
+            state['retry'].append([(high or 0) + 1, 2 ** 62])
+        #posts written since the reindex started went to the old index, they are copied before the swap
+        #changes and deletes made during the reindex to rows that were already copied are not, they are only in
+        #the old index, run the reindex when the site is quiet or reindex in place (without new_index) afterwards
+    if state['retry']:
+        _write_state(state_path, state)
+        #some documents failed, the state file is kept so --resume sends their ranges again,
+        #a new index is only swapped in once nothing failed
+        return {'target': target, 'rows': rows, 'failed': failed, 'seconds': time.perf_counter() - started,
+                'complete': False}
+    if state['swap']:
+        get_backend().swap_alias(index, target)
+        _invalidate({index})
+    os.remove(state_path)
+    return {'target': target, 'rows': rows, 'failed': failed, 'seconds': time.perf_counter() - started,
+            'complete': True}
@@ -1,34 +1,27 @@
-import time
+import os
 import sys
-import json
-from flask import render_template
-from rq import get_current_job
-from app import create_app, db
-from app.models import User, Post, Task
-from app.email import send_email
+from flask import current_app, has_app_context
+from app import create_app, db, export, language, translate
+from app.models import User
+from app.progress import ProgressReporter
 import sqlalchemy as sa
 
 # Create app context for the worker by initializing the flask app
-app = create_app() #create an instance
-app.app_context().push()  #add context from microblog.py
-
-def _set_task_progress(progress):
-    """Helper function to update task progress"""
-    job = get_current_job() #get current job context
-    if job:
-        job.meta['progress'] = progress #store progess in redis
-        job.save_meta()  #save to redis
-        task = db.session.get(Task, job.get_id())  #load the task from database
-        if task:  # Make sure task exists
-            task.user.add_notification('task_progress', {'task_id': job.get_id(),
-                                                         'progress': progress}) #we send a notification to the user
-            if progress >= 100: #if task complete
-                task.complete = True
-            db.session.commit()
+if has_app_context():
+    app = current_app._get_current_object()
+    #"flask worker" imports this file once in its app context (app/worker.py), the jobs use that app
+else:
+    app = create_app() #create an instance
+    app.app_context().push()  #add context from microblog.py
+    #"rq worker" imports this file in every work horse, so each one builds its own app
+#the langdetect profiles are loaded by "flask worker" before the first job (worker.preload()), not at import,
+#so a plain "rq worker" work horse only loads them when it runs a detection job
 
 def export_posts(user_id):
-    """Background task to export user's posts to JSON and email them"""
+    """Background task to export user's posts to a compressed NDJSON file and email it"""
     #try/except/finally runs in RQ worker not flask so flask wont catch errors here so we have to handle them properly
+    progress = ProgressReporter()
+    #reports the progress to the task and the user, at most every few seconds or percent (app/progress.py)
     try:
         print(f"Starting export for user {user_id}")  # for Debugging
         user = db.session.get(User, user_id) #load the user from the database
@@ -38,53 +31,65 @@ def export_posts(user_id):
             return
         
         print(f"Found user: {user.username}")  #if the user is found start the task
-        _set_task_progress(0)
-        
-        data = [] #list to collect post data
-        i = 0  #counter for progress calculation
+        progress.update(0)
+        export.prune() #deletes the archives of older exports whose link has expired
         
         # Count total user posts
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(
+        progress.total = db.session.scalar(sa.select(sa.func.count()).select_from(
             user.posts.select().subquery()))
         
-        print(f"Total posts to export: {total_posts}") 
+        print(f"Total posts to export: {progress.total}") 
         
-        if total_posts == 0:
+        if progress.total == 0:
             print("No posts to export")
-            _set_task_progress(100)  #if no posts to export mark the task as done and return
-            return
+            return #the finally block marks the task as done
         
-        # Export each post
-        for post in db.session.scalars(user.posts.select().order_by(
-                Post.timestamp.asc())): #order the posts from older first
-            data.append({
-                'body': post.body,
-                'timestamp': post.timestamp.isoformat() + 'Z'
-            })  #add the post to the collection, post and timestamp
-            print(f"Exported post {i+1}/{total_posts}")
-            #time.sleep(2)  # Reduced from 5 to 2 seconds for faster testing
-            i += 1 #increment the counter
-            _set_task_progress(100 * i // total_posts) #update the progress of the task with a percentage
-
-        print(f"Finished exporting {len(data)} posts")
-        
-        # Send email with data
-        print("Sending email...")
-        send_email(
-            '[Microblog] Your blog posts',
-            sender=app.config['ADMINS'][0], 
-            recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            attachments=[('posts.json', 'application/json',
-                          json.dumps({'posts': data}, indent=4))],
-            sync=True)
+        # Export the posts to a compressed file
+        path = export.new_file(user)
+        try:
+            with open(path, 'wb') as f:
+                count = export.write_posts(user, f, progress) #streams the posts in batches, see app/export.py
+            print(f"Finished exporting {count} posts ({progress.reports} progress updates, "
+                  f"{os.path.getsize(path)} bytes)")
+            
+            # Send email with the archive attached or linked
+            print("Sending email...")
+            export.send_archive(user, path)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path) #a failed export leaves no file behind
+            raise
         print("Email sent successfully")
         
     except Exception as e:
         print(f"ERROR: {str(e)}")
-        _set_task_progress(100) #marks task as done even though it failed
         app.logger.error('Unhandled exception', exc_info=sys.exc_info()) #then we log the error with the full stack trace(sys.exc_info())
     finally: #always runs success or failure
-        _set_task_progress(100) #mark task as done
+        progress.finish() #mark task as done
         print("Task completed") 
+
+
+def pretranslate_posts(hours, budget, rate):
+    """Background task to translate the recent posts into the locales of the active users"""
+    #it is not started by a user, so there is no Task record or progress, "flask translate prewarm" enqueues it
+    try:
+        result = translate.pretranslate(hours=hours, budget=budget, rate=rate)
+        print(f"Pre-translation done: {result}")
+        if result['error']:
+            app.logger.error(f"Pre-translation stopped: {result['error']}")
+        return result
+    except Exception:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+def detect_post_languages():
+    """Background task to detect the language of the new posts"""
+    #enqueued by app/language.py after a commit that inserted posts, one job handles every pending post
+    try:
+        app.redis.delete(language.QUEUED)
+        #posts committed from now on enqueue the next job, the ones before are picked up by this one
+        count = language.detect_posts()
+        print(f"Detected the language of {count} posts")
+        return count
+    except Exception:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
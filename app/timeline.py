@@ -0,0 +1,339 @@
+from datetime import datetime, timezone
+import redis
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+from app import db
+from app.models import Post, TimelineEntry, followers
+from app.pagination import CursorPage, decode_cursor
+
+#this file keeps a materialized home timeline for every user (fan-out-on-write)
+#instead of running User.following_posts() on every visit to the index page, the ids of the posts that belong
+#on a user's timeline are pushed to it when the post is committed, so reading a page is a single range lookup
+#there are two backends with the same methods:
+#RedisTimeline keeps one sorted set per user (member = post id, score = post timestamp)
+#DatabaseTimeline keeps rows in the timeline_entry table, used in tests and when there is no redis server
+#a timeline only receives pushes once it is "warm", a cold timeline is rebuilt from the full query on first read
+#warm is an explicit marker written by the rebuild (a row with post id 0, or the WARM member of the sorted set),
+#so a timeline with no posts on it stays warm instead of being rebuilt on every visit
+
+
+def _score(timestamp):
+    #sqlite gives back naive datetimes, they are stored as UTC so we tag them before converting to epoch seconds
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+MARKER = 0
+#the post id of the row that marks a database timeline warm, there is no post 0
+WARM = 'warm'
+#the sorted set member that marks a redis timeline warm, it has the score +inf so the reads never reach it
+
+
+def _member(post_id):
+    #redis orders the members with the same score by their bytes, zero padded ids sort like the numbers
+    return f'{post_id:020d}'
+
+
+def _audience(session, author_id):
+    #the users whose timeline a post of author_id belongs on: the author and everyone following them
+    query = sa.select(followers.c.follower_id).where(followers.c.followed_id == author_id)
+    return [author_id] + list(session.execute(query).scalars())
+
+
+def _recent_posts(session, author_id, limit):
+    #the newest posts of one author, used to backfill or prune a timeline on follow/unfollow
+    query = sa.select(Post.id, Post.user_id, Post.timestamp).where(
+        Post.user_id == author_id).order_by(Post.timestamp.desc()).limit(limit)
+    return session.execute(query).all()
+
+
+class DatabaseTimeline:
+    def __init__(self, depth):
+        self.depth = depth
+
+    def _warm(self, user_id):
+        return sa.exists().where(TimelineEntry.user_id == user_id)
+
+    def _trim(self, session, user_ids):
+        #removes every entry past the first `depth` ones of each timeline
+        ranked = sa.select(
+            TimelineEntry.user_id, TimelineEntry.post_id,
+            sa.func.row_number().over(
+                partition_by=TimelineEntry.user_id,
+                order_by=(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc())
+            ).label('position')
+        ).where(TimelineEntry.user_id.in_(user_ids), TimelineEntry.post_id != MARKER).subquery()
+        stale = sa.select(ranked.c.user_id, ranked.c.post_id).where(ranked.c.position > self.depth)
+        session.execute(sa.delete(TimelineEntry).where(
+            sa.tuple_(TimelineEntry.user_id, TimelineEntry.post_id).in_(stale)))
+
+    def push(self, session, post):
+        user_ids = _audience(session, post.user_id)
+        warm = sa.select(TimelineEntry.user_id).where(
+            TimelineEntry.user_id.in_(user_ids)).distinct().subquery()
+        #one INSERT ... SELECT adds the post to every warm timeline in the audience
+        session.execute(sa.insert(TimelineEntry).from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            sa.select(warm.c.user_id, sa.literal(post.id), sa.literal(post.user_id),
+                      sa.literal(post.timestamp, TimelineEntry.timestamp.type))))
+        self._trim(session, user_ids)
+
+    def remove(self, session, post):
+        session.execute(sa.delete(TimelineEntry).where(TimelineEntry.post_id == post.id))
+
+    def follow(self, session, user_id, author_id):
+        if not session.execute(sa.select(self._warm(user_id))).scalar():
+            return
+        existing = sa.select(TimelineEntry.post_id).where(TimelineEntry.user_id == user_id)
+        recent = sa.select(Post.id, Post.user_id, Post.timestamp).where(
+            Post.user_id == author_id, Post.id.not_in(existing)).order_by(
+            Post.timestamp.desc()).limit(self.depth).subquery()
+        session.execute(sa.insert(TimelineEntry).from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'],
+            sa.select(sa.literal(user_id), recent.c.id, recent.c.user_id, recent.c.timestamp)))
+        self._trim(session, [user_id])
+
+    def unfollow(self, session, user_id, author_id):
+        session.execute(sa.delete(TimelineEntry).where(
+            TimelineEntry.user_id == user_id, TimelineEntry.author_id == author_id))
+
+    def rebuild(self, user):
+        recent = user.following_posts().limit(self.depth).subquery()
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(sa.delete(TimelineEntry).where(TimelineEntry.user_id == user.id))
+                connection.execute(sa.insert(TimelineEntry).values(
+                    user_id=user.id, post_id=MARKER, author_id=MARKER, timestamp=datetime(1970, 1, 1)))
+                connection.execute(sa.insert(TimelineEntry).from_select(
+                    ['user_id', 'post_id', 'author_id', 'timestamp'],
+                    sa.select(sa.literal(user.id), recent.c.id, recent.c.user_id, recent.c.timestamp)))
+        except sa.exc.IntegrityError:
+            pass
+            #another request rebuilt the same cold timeline at the same time, its rows are the ones kept
+        #a connection of its own, the request that reads the timeline doesn't commit its session
+
+    def read(self, user_id, count, before=None, after=None):
+        #returns up to count post ids older than before (or newer than after, oldest first), None when the timeline is cold
+        key = sa.tuple_(TimelineEntry.timestamp, TimelineEntry.post_id)
+        query = sa.select(TimelineEntry.post_id).where(TimelineEntry.user_id == user_id,
+                                                        TimelineEntry.post_id != MARKER)
+        if after is not None:
+            query = query.where(key > after).order_by(TimelineEntry.timestamp.asc(), TimelineEntry.post_id.asc())
+        else:
+            if before is not None:
+                query = query.where(key < before)
+            query = query.order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc())
+        ids = list(db.session.scalars(query.limit(count)))
+        if not ids and not db.session.scalar(sa.select(self._warm(user_id))):
+            return None
+        return ids
+
+    def size(self, user_id):
+        return db.session.scalar(sa.select(sa.func.count()).where(TimelineEntry.user_id == user_id,
+                                                                   TimelineEntry.post_id != MARKER))
+
+    def after_commit(self, session):
+        pass
+        #database writes are part of the transaction so there is nothing left to do
+
+    def after_rollback(self, session):
+        pass
+
+
+class RedisTimeline:
+    def __init__(self, connection, depth):
+        self.redis = connection
+        self.depth = depth
+
+    @staticmethod
+    def key(user_id):
+        return f'timeline:{user_id}'
+
+    def _defer(self, session, func):
+        #redis is not transactional with the database, so writes wait for the commit and are dropped on rollback
+        session.info.setdefault('timeline_pending', []).append(func)
+
+    def _warm_keys(self, user_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zscore(self.key(user_id), WARM)
+        return [self.key(user_id) for user_id, found in zip(user_ids, pipe.execute()) if found is not None]
+
+    def push(self, session, post):
+        member, score = _member(post.id), _score(post.timestamp)
+        keys = self._warm_keys(_audience(session, post.user_id))
+
+        def apply(pipe):
+            for key in keys:
+                pipe.zadd(key, {member: score})
+                pipe.zremrangebyrank(key, 0, -(self.depth + 2))
+                #keeps the depth newest posts and the WARM member, which has the highest score
+        self._defer(session, apply)
+
+    def remove(self, session, post):
+        keys = [self.key(user_id) for user_id in _audience(session, post.user_id)]
+        member = _member(post.id)
+
+        def apply(pipe):
+            for key in keys:
+                pipe.zrem(key, member)
+        self._defer(session, apply)
+
+    def follow(self, session, user_id, author_id):
+        key = self.key(user_id)
+        if self.redis.zscore(key, WARM) is None:
+            return
+        mapping = {_member(id): _score(timestamp)
+                   for id, _, timestamp in _recent_posts(session, author_id, self.depth)}
+        if not mapping:
+            return
+
+        def apply(pipe):
+            pipe.zadd(key, mapping)
+            pipe.zremrangebyrank(key, 0, -(self.depth + 2))
+        self._defer(session, apply)
+
+    def unfollow(self, session, user_id, author_id):
+        key = self.key(user_id)
+        members = [_member(id) for id, _, _ in _recent_posts(session, author_id, self.depth)]
+        if not members:
+            return
+
+        def apply(pipe):
+            pipe.zrem(key, *members)
+        self._defer(session, apply)
+
+    def rebuild(self, user):
+        key = self.key(user.id)
+        mapping = {_member(post.id): _score(post.timestamp) for post in
+                   db.session.scalars(user.following_posts().limit(self.depth))}
+        mapping[WARM] = float('inf')
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        pipe.zadd(key, mapping)
+        pipe.execute()
+        #a timeline written before the marker existed has none, it is seen as cold and rebuilt once
+
+    def read(self, user_id, count, before=None, after=None):
+        #pages by (timestamp, id) like DatabaseTimeline.read: the posts with the cursor's score are read on their own
+        #and filtered by id, then the rest of the page comes from past that score
+        key = self.key(user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zscore(key, WARM)
+        cursor = after if after is not None else before
+        if cursor is not None:
+            score = _score(cursor[0])
+            pipe.zrangebyscore(key, score, score)
+        if after is not None:
+            pipe.zrangebyscore(key, f'({score!r}', '(+inf', start=0, num=count)
+        elif before is not None:
+            pipe.zrevrangebyscore(key, f'({score!r}', '-inf', start=0, num=count)
+        else:
+            pipe.zrevrangebyscore(key, '(+inf', '-inf', start=0, num=count)
+        results = pipe.execute()
+        if results[0] is None:
+            return None
+        members = results[-1]
+        if cursor is not None:
+            ties = sorted(int(member) for member in results[1])
+            if after is not None:
+                members = [id for id in ties if id > cursor[1]] + [int(member) for member in members]
+            else:
+                members = [id for id in reversed(ties) if id < cursor[1]] + [int(member) for member in members]
+            return members[:count]
+        return [int(member) for member in members]
+
+    def size(self, user_id):
+        return self.redis.zcard(self.key(user_id)) - 1
+        #without the WARM member
+
+    def after_commit(self, session):
+        pending = session.info.pop('timeline_pending', None)
+        if not pending:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for apply in pending:
+            apply(pipe)
+        pipe.execute()
+
+    def after_rollback(self, session):
+        session.info.pop('timeline_pending', None)
+
+
+def get_timeline():
+    #returns the backend selected by the TIMELINE_BACKEND config variable
+    depth = current_app.config['TIMELINE_DEPTH']
+    if current_app.config['TIMELINE_BACKEND'] == 'redis':
+        return RedisTimeline(current_app.redis, depth)
+    return DatabaseTimeline(depth)
+
+
+def paginate(user, per_page, before=None, after=None):
+    #reads one page of the user's home timeline, before/after are the cursors from the request (app/pagination.py)
+    #returns None when the caller should fall back to User.following_posts(): redis is unreachable
+    #or the page reaches past the depth that is kept. a cold timeline is rebuilt first and then read
+    timeline = get_timeline()
+    columns = (Post.timestamp, Post.id)
+    before_key = decode_cursor(before, columns)
+    after_key = None if before_key is not None else decode_cursor(after, columns)
+    try:
+        ids = timeline.read(user.id, per_page + 1, before_key, after_key)
+        if ids is None:
+            timeline.rebuild(user)
+            ids = timeline.read(user.id, per_page + 1, before_key, after_key)
+            #the page is read from the rebuilt timeline, not from the full query a second time
+        if after_key is None and len(ids) <= per_page and timeline.size(user.id) >= timeline.depth:
+            return None
+            #this is the oldest end of a full timeline, older posts may have been trimmed from it
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error reading timeline of user {user.id}: {e}")
+        return None
+    query = sa.select(Post).where(Post.id.in_(ids)).options(so.selectinload(Post.author))
+    posts = {post.id: post for post in db.session.scalars(query)}
+    return CursorPage([posts[id] for id in ids if id in posts], per_page, columns, descending=True,
+                      backwards=after_key is not None,
+                      from_cursor=before_key is not None or after_key is not None)
+
+
+def follow(user, author):
+    #called by User.follow() so the new author's recent posts show up on the user's timeline
+    _run('follow', db.session, user.id, author.id)
+
+
+def unfollow(user, author):
+    #called by User.unfollow() so the posts of the author are pruned from the user's timeline
+    _run('unfollow', db.session, user.id, author.id)
+
+
+def _run(method, session, *args):
+    try:
+        getattr(get_timeline(), method)(session, *args)
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error updating timelines ({method}): {e}")
+
+
+def after_flush(session, flush_context):
+    #new posts are fanned out and deleted posts are pruned in the same transaction that writes them
+    for obj in session.new:
+        if isinstance(obj, Post):
+            _run('push', session, obj)
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            _run('remove', session, obj)
+
+
+def after_commit(session):
+    if 'timeline_pending' in session.info:
+        _run('after_commit', session)
+
+
+def after_rollback(session):
+    session.info.pop('timeline_pending', None)
+
+
+db.event.listen(db.session, 'after_flush', after_flush)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+#these listeners keep the timelines in sync with the post table, like the SearchableMixin listeners in models.py
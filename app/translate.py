@@ -1,20 +1,130 @@
+import collections
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import threading
+import time
+import redis
 import requests
 #this imports the requests library to make HTTP requests to the Microsoft Translator API
+import sqlalchemy as sa
 from flask_babel import _
 #this imports the _ function from flask_babel for translations
 from flask import current_app
+from app import db
+from app.models import User, Post, Translation
+
+#translations are cached in two tiers so the same post is not sent to the paid API again and again:
+#1. an LRU dict in each process (TRANSLATION_CACHE_SIZE entries), no round trip at all
+#2. a persistent cache shared by all the processes, redis keys or the translation table (TRANSLATION_CACHE_BACKEND)
+#the key is a sha256 of (text, source language, dest language), so long posts make short keys
+#errors are never cached, the next click tries the API again
+
+MAX_TEXTS = 1000
+MAX_CHARACTERS = 50000
+#the limits of one Translator API request, longer lists are split into several requests
+MAX_BATCH = 100
+#the most (post, language) pairs the batch endpoint accepts in one request
+TIMEOUT = 10
+#seconds to wait for the API before the translation is reported as failed
+
+
+def _normalize(language):
+    return language.split("_")[0] #en_US -> en
+
+
+def cache_key(text, source_language, dest_language):
+    data = json.dumps([text, _normalize(source_language), _normalize(dest_language)])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class LocalCache:
+    #the first tier, a thread safe LRU dict with hit/miss counters for the whole translation cache
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
-def translate(text, source_language, dest_language):
 
-    #this function translates text from source_language to dest_language using the Microsoft Translator API
+def get_local_cache():
+    if 'translation_cache' not in current_app.extensions:
+        current_app.extensions['translation_cache'] = LocalCache(current_app.config['TRANSLATION_CACHE_SIZE'])
+    return current_app.extensions['translation_cache']
+
+
+def _load(keys):
+    #reads the second tier, returns {key: text} for the keys that were found
+    if current_app.config['TRANSLATION_CACHE_BACKEND'] == 'redis':
+        values = current_app.redis.mget([f'translation:{key}' for key in keys])
+        return {key: value.decode('utf-8') for key, value in zip(keys, values) if value is not None}
+    query = sa.select(Translation.cache_key, Translation.text).where(Translation.cache_key.in_(keys))
+    with db.engine.connect() as connection:
+        return dict(connection.execute(query).all())
+
+
+def _save(translations):
+    #writes {key: text} to the second tier
+    if current_app.config['TRANSLATION_CACHE_BACKEND'] == 'redis':
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key, text in translations.items():
+            pipe.set(f'translation:{key}', text, ex=current_app.config['TRANSLATION_CACHE_TTL'])
+        pipe.execute()
+        return
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(sa.insert(Translation), [
+                {'cache_key': key, 'text': text} for key, text in translations.items()])
+    except sa.exc.IntegrityError:
+        pass
+        #another request stored the same translation first
+    #a connection of its own keeps the cache write out of the request's session
+
+
+def get_session():
+    #one requests.Session per process, it keeps the connections to the API open so TLS is not set up again for every call
+    if 'translator_session' not in current_app.extensions:
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        #pool_maxsize is how many connections are kept for the threads of the process
+        current_app.extensions['translator_session'] = session
+    return current_app.extensions['translator_session']
+
+
+def _chunks(texts):
+    #splits the texts into lists that fit in one API request
+    chunk, size = [], 0
+    for text in texts:
+        if chunk and (len(chunk) == MAX_TEXTS or size + len(text) > MAX_CHARACTERS):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(text)
+        size += len(text)
+    if chunk:
+        yield chunk
+
+
+def _microsoft(texts, source_language, dest_language):
+    #calls the Microsoft Translator API, returns the list of translations or an error message
     if 'MS_TRANSLATOR_KEY' not in current_app.config or not \
            current_app.config['MS_TRANSLATOR_KEY']:
         return _('Error: the translation service is not configured.')
     #this checks if the MS_TRANSLATOR_KEY is set in the app config
 
-    source_language = source_language.split("_")[0] #en_US -> en
-    dest_language = dest_language.split("_")[0]     #es_ES -> es
-    
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': current_app.config['MS_TRANSLATOR_REGION']
@@ -22,23 +132,201 @@ def translate(text, source_language, dest_language):
     #this sets up the authentication headers for the API request
     #the translatory requires an API key and a region header for authentication
     #the region is set to 'global' for the Microsoft Translator service, but it may vary based on your subscription
-    
-
-    #the dictionary from the config file is passed as the headers argument to the requests.post() method
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[{'Text': text}])
-    #this makes a HTTP POST request to the Microsoft Translator API's translate endpoint(first argument)
-    #second argument is the headers(api key and region)
-    #the third argument is the JSON payload containing the text to be translated
-
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    #this checks if the request was successful
-    return r.json()[0]['translations'][0]['text']
-    #this extracts and returns the translated text from the API response
-    #the response is in JSON format, and we navigate through the structure to get the translated text
-    #r.json() converts the response to a Python list,
-    #[0] accesses the first item in the list
-    #'translations'[0] accesses the first translation in the translations array
-    #'text' gets the actual translated text string
\ No newline at end of file
+
+    translations = []
+    for chunk in _chunks(texts):
+        #the dictionary from the config file is passed as the headers argument to the post() method
+        try:
+            r = get_session().post(
+                'https://api.cognitive.microsofttranslator.com/translate',
+                params={'api-version': '3.0', 'from': source_language, 'to': dest_language},
+                headers=auth, json=[{'Text': text} for text in chunk], timeout=TIMEOUT)
+        except requests.exceptions.RequestException:
+            return _('Error: the translation service failed.')
+        #this makes a HTTP POST request to the Microsoft Translator API's translate endpoint(first argument)
+        #the params are the query string, the headers are the api key and region
+        #the json argument is the payload containing the texts to be translated
+
+        if r.status_code != 200:
+            return _('Error: the translation service failed.')
+        #this checks if the request was successful
+        translations.extend(item['translations'][0]['text'] for item in r.json())
+        #this extracts the translated texts from the API response
+        #the response is in JSON format, a list with one item per text in the same order
+        #'translations'[0] accesses the first translation in the translations array
+        #'text' gets the actual translated text string
+    return translations
+
+
+def _stub(texts, source_language, dest_language):
+    #stands in for the API in tests and development (TRANSLATOR = 'stub'), no network and no cost
+    return [f'[{dest_language}] {text}' for text in texts]
+
+
+def _upstream(texts, source_language, dest_language):
+    translator = _stub if current_app.config['TRANSLATOR'] == 'stub' else _microsoft
+    stats = get_local_cache().stats
+    stats['upstream'] += len(texts)
+    stats['upstream_calls'] += 1
+    return translator(texts, source_language, dest_language)
+
+
+def translate_many(texts, source_language, dest_language):
+    #translates a list of texts from one language to another, going through both cache tiers first
+    #returns the list of translations, or an error message if the texts that were not cached could not be translated
+    source_language = _normalize(source_language)
+    dest_language = _normalize(dest_language)
+    local = get_local_cache()
+    keys = [cache_key(text, source_language, dest_language) for text in texts]
+    found = {}
+    for key in keys:
+        text = local.get(key)
+        if text is not None:
+            found[key] = text
+    local.stats['local_hits'] += len(found)
+
+    missing = [key for key in dict.fromkeys(keys) if key not in found]
+    if missing:
+        try:
+            shared = _load(missing)
+        except (redis.exceptions.RedisError, sa.exc.SQLAlchemyError) as e:
+            current_app.logger.exception(f"Error reading the translation cache: {e}")
+            shared = {}
+        local.stats['shared_hits'] += len(shared)
+        for key, text in shared.items():
+            local.put(key, text)
+        found.update(shared)
+
+    todo = {key: text for key, text in zip(keys, texts) if key not in found}
+    #the texts that are in neither tier, each one is sent once even if it appears twice
+    if todo:
+        local.stats['misses'] += len(todo)
+        result = _upstream(list(todo.values()), source_language, dest_language)
+        if isinstance(result, str):
+            return result
+            #an error message from the translator
+        translations = dict(zip(todo, result))
+        for key, text in translations.items():
+            local.put(key, text)
+        try:
+            _save(translations)
+        except (redis.exceptions.RedisError, sa.exc.SQLAlchemyError) as e:
+            current_app.logger.exception(f"Error writing the translation cache: {e}")
+        found.update(translations)
+    return [found[key] for key in keys]
+
+
+def translate(text, source_language, dest_language):
+    #this function translates text from source_language to dest_language, through the cache and the translator
+    result = translate_many([text], source_language, dest_language)
+    return result if isinstance(result, str) else result[0]
+
+
+def translate_posts(pairs):
+    #translates posts for the batch endpoint, pairs is a list of (post_id, dest_language)
+    #the pairs are grouped by language pair, so a page of posts makes one translator call per pair at most
+    #returns {(post_id, dest_language): translation or error message}, posts without a language are left out
+    posts = db.session.execute(sa.select(Post.id, Post.body, Post.language).where(
+        Post.id.in_({pair[0] for pair in pairs}))).all()
+    posts = {post.id: post for post in posts}
+    groups = {}
+    for post_id, dest_language in dict.fromkeys(pairs):
+        post = posts.get(post_id)
+        if post is None or not post.language:
+            continue
+        groups.setdefault((_normalize(post.language), _normalize(dest_language)), []).append(
+            ((post_id, dest_language), post.body))
+    result = {}
+    for (source_language, dest_language), group in groups.items():
+        texts = translate_many([body for pair, body in group], source_language, dest_language)
+        for i, (pair, body) in enumerate(group):
+            result[pair] = texts if isinstance(texts, str) else texts[i]
+    return result
+
+
+def active_locales(since):
+    #returns the languages the users seen since the given time read the site in, e.g. {'en', 'es'}
+    query = sa.select(User.locale).where(User.last_seen >= since, User.locale.is_not(None)).distinct()
+    return {_normalize(locale) for locale in db.session.scalars(query)}
+
+
+def pretranslate(hours=24, budget=100000, rate=500, batch=100):
+    #fills the shared cache with translations of the posts of the last hours into the active locales,
+    #so the Translate links of those posts are cache hits. it is run by the pretranslate_posts task (app/tasks.py)
+    #budget is the most characters sent to the translator in one run (the API is billed per character)
+    #rate is the most characters per second, so the run stays under the API rate limit and leaves room for the site
+    #returns a dict with what was done
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    locales = active_locales(since)
+    result = {'locales': sorted(locales), 'posts': 0, 'cached': 0, 'translated': 0, 'characters': 0,
+              'budget_exhausted': False, 'error': None}
+    if not locales:
+        return result
+    query = sa.select(Post.id, Post.body, Post.language, Post.timestamp).where(
+        Post.timestamp >= since, Post.language.is_not(None), Post.language != '').order_by(
+        Post.timestamp.desc(), Post.id.desc()).limit(batch)
+    #the newest posts first, they are the ones most likely to be read
+    #posts whose language could not be detected ('') have no Translate link
+    started = time.monotonic()
+    last = None
+    while True:
+        page = query if last is None else query.where(sa.tuple_(Post.timestamp, Post.id) < last)
+        with db.engine.connect() as connection:
+            posts = connection.execute(page).all()
+        #each batch is a short query of its own (keyset on timestamp, id) on a connection that is given back before
+        #the translations are written, sqlite can't commit them while another connection is still reading.
+        #the session of the caller is left alone
+        if not posts:
+            break
+        last = (posts[-1].timestamp, posts[-1].id)
+        result['posts'] += len(posts)
+        groups = {}
+        for post in posts:
+            source_language = _normalize(post.language)
+            for dest_language in locales - {source_language}:
+                groups.setdefault((source_language, dest_language), {})[
+                    cache_key(post.body, source_language, dest_language)] = post.body
+        for (source_language, dest_language), texts in groups.items():
+            try:
+                cached = _load(list(texts))
+            except (redis.exceptions.RedisError, sa.exc.SQLAlchemyError) as e:
+                current_app.logger.exception(f"Error reading the translation cache: {e}")
+                cached = {}
+            result['cached'] += len(cached)
+            todo = {key: text for key, text in texts.items() if key not in cached}
+            if not todo:
+                continue
+            characters = sum(len(text) for text in todo.values())
+            if result['characters'] + characters > budget:
+                result['budget_exhausted'] = True
+                return result
+            translations = _upstream(list(todo.values()), source_language, dest_language)
+            if isinstance(translations, str):
+                result['error'] = translations
+                return result
+            try:
+                _save(dict(zip(todo, translations)))
+            except (redis.exceptions.RedisError, sa.exc.SQLAlchemyError) as e:
+                current_app.logger.exception(f"Error writing the translation cache: {e}")
+            #like in translate_many(), a cache that can't be written doesn't stop the run
+            result['translated'] += len(todo)
+            result['characters'] += characters
+            wait = result['characters'] / rate - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+            #sleeps until the average is back under rate characters per second
+    return result
+
+
+def translation_stats():
+    #returns the lookup counters of this process and the share of them served from each tier
+    stats = get_local_cache().stats
+    lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+    return {
+        'local_hits': stats['local_hits'],
+        'shared_hits': stats['shared_hits'],
+        'misses': stats['misses'],
+        'upstream': stats['upstream'],
+        'upstream_calls': stats['upstream_calls'],
+        'hit_ratio': (stats['local_hits'] + stats['shared_hits']) / lookups if lookups else 0.0,
+    }
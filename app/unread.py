@@ -0,0 +1,115 @@
+from datetime import datetime
+import redis
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+from app import db
+from app.models import User, Message
+
+#this file keeps a counter of unread private messages for every user
+#base.html shows the count in the navbar on every page, so it has to be cheap to read instead of a COUNT over message
+#there are two backends, selected with the UNREAD_COUNTER_BACKEND config variable:
+#'db' keeps the count in the User.num_unread_messages column, it is loaded with current_user so reading it is free
+#'redis' keeps it in the unread:<user_id> key, a missing key is rebuilt with the COUNT query on the next read
+#in both cases the counter goes up when a message is written and back to 0 when the user opens the messages page
+
+TTL = 24 * 3600
+#redis counters expire after a day, so a counter that drifted (e.g. a message rolled back after it was counted)
+#is recounted from the message table at least once a day
+
+_INCREMENT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incrby', KEYS[1], ARGV[1])
+end
+return false
+"""
+#a plain INCRBY would create a missing key with the wrong value, the script only increments counters that already exist
+#so a missing counter is recounted from the database instead of starting from a wrong value
+
+
+def key(user_id):
+    return f'unread:{user_id}'
+
+
+def _use_redis():
+    return current_app.config['UNREAD_COUNTER_BACKEND'] == 'redis'
+
+
+def count_query(user):
+    #the COUNT the counter replaces, used to rebuild a missing redis counter
+    last_read_time = user.last_message_read_time or datetime(1900, 1, 1)
+    query = sa.select(Message.id).where(Message.recipient_id == user.id, Message.timestamp > last_read_time)
+    return sa.select(sa.func.count()).select_from(query.subquery())
+
+
+def get(user):
+    #returns the number of unread messages of the user
+    if not _use_redis():
+        return user.num_unread_messages or 0
+    try:
+        value = current_app.redis.get(key(user.id))
+        if value is not None:
+            return int(value)
+        count = db.session.scalar(count_query(user))
+        current_app.redis.set(key(user.id), count, ex=TTL, nx=True)
+        #nx=True keeps a counter that another request created in the meantime
+        return count
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error reading unread counter of user {user.id}: {e}")
+        return db.session.scalar(count_query(user))
+
+
+def reset(user):
+    #called when the user opens the messages page, the new value is written when the request commits
+    if not _use_redis():
+        user.num_unread_messages = 0
+        return
+    db.session.info.setdefault('unread_pending', []).append(
+        lambda pipe: pipe.set(key(user.id), 0, ex=TTL))
+
+
+def after_flush(session, flush_context):
+    #counts the messages written in this flush per recipient
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Message):
+            deltas[obj.recipient_id] = deltas.get(obj.recipient_id, 0) + 1
+    if not deltas:
+        return
+    if _use_redis():
+        increment = current_app.redis.register_script(_INCREMENT)
+        for user_id, delta in deltas.items():
+            session.info.setdefault('unread_pending', []).append(
+                lambda pipe, user_id=user_id, delta=delta: increment(keys=[key(user_id)], args=[delta], client=pipe))
+        #redis is not transactional with the database, the increments wait for the commit like the timeline writes
+        return
+    user = User.__table__
+    for user_id, delta in deltas.items():
+        session.connection().execute(sa.update(user).where(user.c.id == user_id).values(
+            num_unread_messages=user.c.num_unread_messages + delta))
+        recipient = session.identity_map.get(so.util.identity_key(User, user_id))
+        if recipient is not None:
+            session.expire(recipient, ['num_unread_messages'])
+
+
+def after_commit(session):
+    pending = session.info.pop('unread_pending', None)
+    if not pending:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for apply in pending:
+            apply(pipe)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        current_app.logger.exception(f"Error updating unread counters: {e}")
+
+
+def after_rollback(session):
+    session.info.pop('unread_pending', None)
+
+
+db.event.listen(db.session, 'after_flush', after_flush)
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
+#these listeners keep the counters in step with the message table, like the ones in app/timeline.py
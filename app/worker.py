@@ -0,0 +1,53 @@
+import importlib
+import rq
+from flask import current_app
+from app import db, language
+
+#this file runs the RQ worker of "flask worker"
+#"rq worker microblog-tasks" forks a work horse for every job and the work horse imports app.tasks, which calls
+#create_app() (blueprints, babel, the elasticsearch and redis clients), so every job paid for a whole app start
+#before doing any work, and the language detection jobs loaded the langdetect profiles on top of it
+#"flask worker" imports app.tasks and loads the profiles once in the parent, inside the app of the flask command,
+#then the work horses are forked with all of it in memory (mode 'fork'), or the jobs run in the parent ('in-process')
+
+
+class _JobSession:
+    #every job starts with a new database session, nothing is left over from the job before
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            db.session.remove()
+
+
+class ForkWorker(_JobSession, rq.Worker):
+    #forks a work horse for each job like rq.Worker, the app is already built in the parent
+    def main_work_horse(self, job, queue):
+        db.engine.dispose(close=False)
+        #the work horse must not use the pooled connections of the parent, they are shared with it after the fork,
+        #close=False leaves them open for the parent. redis-py makes new connections after a fork by itself
+        super().main_work_horse(job, queue)
+
+
+class InProcessWorker(_JobSession, rq.SimpleWorker):
+    #runs the jobs in the worker process itself, no fork at all, the database connections are reused from the pool
+    #a job that crashes the process or leaks memory takes the worker with it, and a stuck job can't be killed by the
+    #job timeout the same way, so 'fork' is the default
+    pass
+
+
+WORKERS = {'fork': ForkWorker, 'in-process': InProcessWorker}
+
+
+def preload():
+    #imports the task functions and loads what they need, called in the parent before any job
+    importlib.import_module('app.tasks')
+    #app/tasks.py uses the app of the command when it is imported in an app context, it doesn't build another one
+    language.warm()
+
+
+def create_worker(mode='fork', queues=None):
+    #returns a worker for the given mode listening on the queues, the queue of the app by default
+    preload()
+    queues = queues or [current_app.task_queue.name]
+    return WORKERS[mode](queues, connection=current_app.redis)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#this benchmark compares the indexing and query latency of the search backends in app/search.py
+#the FTS5 backend always runs, Elasticsearch runs too when ELASTICSEARCH_URL is set
+#
+#usage:
+#   python benchmarks/search_backends.py                      (FTS5 file in a temporary directory)
+#   ELASTICSEARCH_URL=http://localhost:9200 python benchmarks/search_backends.py --docs 200000
+#
+#the documents go to a "bench_post" index which is deleted at the end, the post index is not touched
+#the text is made of words drawn from a Zipf distribution, like real text a few words are in most posts
+
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import create_app, search
+from config import Config
+
+INDEX = 'bench_post'
+
+
+def vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def make_posts(n, words, rng):
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    for i in range(1, n + 1):
+        yield {'op': 'index', 'index': INDEX, 'id': i,
+               'document': {'body': ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(5, 25)))}}
+
+
+def bench_indexing(backend, posts, batch):
+    started = time.perf_counter()
+    count = 0
+    chunk = []
+    for action in posts:
+        chunk.append(action)
+        if len(chunk) == batch:
+            backend.send(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        backend.send(chunk)
+        count += len(chunk)
+    return count / (time.perf_counter() - started)
+
+
+def bench_queries(backend, queries, runs):
+    timings = []
+    for query in queries:
+        for _ in range(runs):
+            started = time.perf_counter()
+            backend.query(INDEX, query, ['body'], 1, 25)
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the FTS5 and Elasticsearch search backends.')
+    parser.add_argument('--docs', type=int, default=100000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=500, help='documents per bulk request')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=3, help='timed runs per query')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    class BenchConfig(Config):
+        SEARCH_FTS_URL = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'search.db')
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        rng = random.Random(args.seed)
+        words = vocabulary(args.vocabulary, rng)
+        queries = [' '.join(rng.sample(words[:2000], rng.randint(1, 3))) for _ in range(args.queries)]
+        #the queries use the more common words so they have hits
+
+        backends = [('fts5', search.FTSBackend(BenchConfig.SEARCH_FTS_URL))]
+        if app.elasticsearch:
+            backends.append(('elasticsearch', search.ElasticsearchBackend()))
+        else:
+            print('ELASTICSEARCH_URL is not set, only the FTS5 backend is measured')
+
+        print(f'{args.docs} documents, batches of {args.batch}, {args.queries} queries x {args.runs} runs')
+        print(f'{"backend":>14} {"docs/s":>10} {"median ms":>10} {"p95 ms":>10}')
+        for name, backend in backends:
+            if name == 'elasticsearch':
+                app.elasticsearch.options(ignore_status=404).indices.delete(index=INDEX)
+            rate = bench_indexing(backend, make_posts(args.docs, words, random.Random(args.seed)), args.batch)
+            if name == 'elasticsearch':
+                app.elasticsearch.indices.refresh(index=INDEX)
+                #makes the documents visible to search, like the periodic refresh would
+            median, p95 = bench_queries(backend, queries, args.runs)
+            print(f'{name:>14} {rate:>10.0f} {median:>10.2f} {p95:>10.2f}')
+            if name == 'elasticsearch':
+                app.elasticsearch.indices.delete(index=INDEX)
+
+
+if __name__ == '__main__':
+    main()
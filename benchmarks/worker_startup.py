@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#this benchmark measures what each background job pays before its task function runs, for the ways to run the worker
+#   rq worker     the work horse starts from the rq process and imports app.tasks, which builds a whole app
+#   flask worker  --mode fork: app.tasks is imported once in the parent, the work horse is a fork of it
+#   flask worker  --mode in-process: the job runs in the worker itself
+#
+#usage:
+#   python benchmarks/worker_startup.py
+#   python benchmarks/worker_startup.py --runs 50
+#
+#no redis or database is needed, the app is built but no job is queued, the task run is a function that returns
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+COLD = '''
+import time
+import rq
+started = time.perf_counter()
+import app.tasks
+print(time.perf_counter() - started)
+'''
+#what an "rq worker" work horse does for its first line of the task, the rq process has only imported rq
+
+
+def cold_start():
+    #runs the import in a new interpreter, like a work horse forked from a process that never imported the app
+    output = subprocess.run([sys.executable, '-c', COLD], cwd=ROOT, check=True, capture_output=True, text=True,
+                            env=dict(os.environ, FLASK_APP='microblog.py')).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def fork_start():
+    #forks the preloaded process and waits for the child to run a job that does nothing
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        from app import db
+        db.engine.dispose(close=False)
+        #what ForkWorker.main_work_horse does before the job
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return time.perf_counter() - started
+
+
+def in_process_start():
+    started = time.perf_counter()
+    from app import db
+    db.session.remove()
+    #what the worker does around each job
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per-job startup time of the worker modes.')
+    parser.add_argument('--runs', type=int, default=20, help='Jobs to time for each mode.')
+    args = parser.parse_args()
+
+    cold = [cold_start() for _ in range(args.runs)]
+
+    from flask import current_app
+    from app import create_app
+    from app import worker
+    started = time.perf_counter()
+    app = create_app()
+    app.app_context().push()
+    worker.preload()
+    print(f'flask worker builds the app and preloads the tasks once: {(time.perf_counter() - started) * 1000:.0f} ms')
+    assert sys.modules['app.tasks'].app is current_app._get_current_object()
+
+    fork = [fork_start() for _ in range(args.runs)]
+    in_process = [in_process_start() for _ in range(args.runs)]
+
+    print(f'\nmedian startup cost of a job over {args.runs} runs, ms:')
+    print(f'{"mode":>24} {"ms":>10} {"speedup":>8}')
+    baseline = statistics.median(cold)
+    for name, times in [('rq worker', cold), ('flask worker fork', fork), ('flask worker in-process', in_process)]:
+        median = statistics.median(times)
+        print(f'{name:>24} {median * 1000:>10.2f} {baseline / median if median else float("inf"):>7.0f}x')
+    #the rq worker time is only the import of app.tasks, the fork of the rq process comes on top of it
+
+
+if __name__ == '__main__':
+    main()
@@ -11,4 +11,5 @@ while true; do
     sleep 5 # Wait for 5 seconds before retrying
 done
 # Now start the Gunicorn server
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
\ No newline at end of file
+# gthread workers by default, each open notification stream holds a thread (see app/docs/notifications.md)
+exec gunicorn -b :5000 --worker-class ${GUNICORN_WORKER_CLASS:-gthread} --threads ${GUNICORN_THREADS:-50} --access-logfile - --error-logfile - microblog:app
\ No newline at end of file
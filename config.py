@@ -57,6 +57,27 @@ class Config:
     #this configuration variable holds the API key for the Microsoft Translator service
     #it is sourced from an environment variable named MS_TRANSLATOR_KEY
 
+    LANGUAGE_DETECTION_MODE = os.environ.get('LANGUAGE_DETECTION_MODE') or \
+        ('async' if os.environ.get('REDIS_URL') else 'sync')
+    #'async' detects the language of new posts in the RQ worker, 'sync' right after the commit in the web process
+    LANGUAGE_DETECTION_SEED = int(os.environ.get('LANGUAGE_DETECTION_SEED') or 0)
+    #langdetect is random, the seed makes the detected languages reproducible
+
+    TRANSLATOR = os.environ.get('TRANSLATOR') or 'microsoft'
+    #the translation service: 'microsoft' (the Translator API) or 'stub' (tests and development, no network)
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 5000)
+    #how many translations each process keeps in memory in front of the shared cache
+    TRANSLATION_CACHE_BACKEND = os.environ.get('TRANSLATION_CACHE_BACKEND') or \
+        ('redis' if os.environ.get('REDIS_URL') else 'db')
+    #where the translations shared by all the processes are kept: 'redis' (one key each) or 'db' (the translation table)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 30 * 24 * 3600)
+    #redis translations expire after 30 days, a post rarely needs translating again after that
+    TRANSLATION_PREWARM_HOURS = int(os.environ.get('TRANSLATION_PREWARM_HOURS') or 24)
+    #"flask translate prewarm" translates the posts of the last this many hours into the locales of the users seen in them
+    TRANSLATION_PREWARM_BUDGET = int(os.environ.get('TRANSLATION_PREWARM_BUDGET') or 100000)
+    TRANSLATION_PREWARM_RATE = int(os.environ.get('TRANSLATION_PREWARM_RATE') or 500)
+    #the most characters one run sends to the translator, and how many per second, the API is billed and limited by characters
+
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL') or None
     #this configuration variable holds the URL for the Elasticsearch server
     #it is sourced from an environment variable named ELASTICSEARCH_URL
@@ -64,3 +85,75 @@ class Config:
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379'
     #this reads the redis url from the environment variable or uses the default
 
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or \
+        ('elasticsearch' if os.environ.get('ELASTICSEARCH_URL') else 'fts')
+    #the search engine: 'elasticsearch', 'fts' (SQLite FTS5 tables, no server needed) or 'none' to turn search off
+    SEARCH_FTS_URL = os.environ.get('SEARCH_FTS_URL') or 'sqlite:///' + os.path.join(basedir, 'search.db')
+    #the database file of the fts backend, it is separate from the main database so it works with any of them
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 600)
+    #how many search result pages each process caches and for how many seconds, a size of 0 turns the cache off
+    SEARCH_GENERATION_BACKEND = os.environ.get('SEARCH_GENERATION_BACKEND') or \
+        ('redis' if os.environ.get('REDIS_URL') else 'memory')
+    #where the index generations that invalidate the cache are kept, 'redis' is shared by all the processes
+    SEARCH_INDEX_MODE = os.environ.get('SEARCH_INDEX_MODE') or 'async'
+    #'async' queues the search index changes and a background thread sends them with the bulk API,
+    #'sync' sends them in the request that committed (tests)
+    SEARCH_BULK_SIZE = int(os.environ.get('SEARCH_BULK_SIZE') or 500)
+    #the most actions sent in one bulk request
+    SEARCH_BULK_INTERVAL = float(os.environ.get('SEARCH_BULK_INTERVAL') or 0.5)
+    #how long the background thread waits to fill a batch, in seconds
+    SEARCH_BULK_RETRIES = int(os.environ.get('SEARCH_BULK_RETRIES') or 3)
+    SEARCH_BULK_BACKOFF = float(os.environ.get('SEARCH_BULK_BACKOFF') or 0.5)
+    #a failed bulk request is retried this many times, waiting 0.5, 1, 2... seconds
+
+    TIMELINE_BACKEND = os.environ.get('TIMELINE_BACKEND') or \
+        ('redis' if os.environ.get('REDIS_URL') else 'db')
+    #where the materialized home timelines are kept: 'redis' (sorted sets) or 'db' (the timeline_entry table)
+    #without an explicit REDIS_URL we assume there is no redis server and use the database
+    TIMELINE_DEPTH = int(os.environ.get('TIMELINE_DEPTH') or 500)
+    #how many posts are kept on each home timeline, older pages fall back to the full query
+
+    UNREAD_COUNTER_BACKEND = os.environ.get('UNREAD_COUNTER_BACKEND') or \
+        ('redis' if os.environ.get('REDIS_URL') else 'db')
+    #where the unread message counters are kept: 'redis' (one key per user) or 'db' (the User.num_unread_messages column)
+
+    NOTIFICATION_BACKEND = os.environ.get('NOTIFICATION_BACKEND') or \
+        ('redis' if os.environ.get('REDIS_URL') else 'db')
+    #where the live notifications are kept: 'redis' (a hash per user, written back to the table) or 'db' (the table)
+    NOTIFICATION_FLUSH_INTERVAL = int(os.environ.get('NOTIFICATION_FLUSH_INTERVAL') or 30)
+    #the redis notifications are written back to the table at most once every this many seconds
+    NOTIFICATION_STREAM = os.environ.get('NOTIFICATION_STREAM') or 'off'
+    #'redis' pushes the notifications to the pages with Server-Sent Events and redis pub/sub, 'off' makes the pages poll
+    #it is off unless asked for: each open stream holds a gunicorn thread (or a greenlet with gevent workers),
+    #turn it on with GUNICORN_WORKER_CLASS=gevent, see app/docs/notifications.md
+    NOTIFICATION_STREAM_LIMIT = int(os.environ.get('NOTIFICATION_STREAM_LIMIT') or 20)
+    #the most streams open at once in one process, the tabs past it poll, so page requests keep free threads
+    #0 is no limit (gevent workers)
+    NOTIFICATION_HEARTBEAT = int(os.environ.get('NOTIFICATION_HEARTBEAT') or 15)
+    #seconds between the heartbeat comments of an idle stream
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 300)
+    #seconds before a stream is closed, the browser reconnects right away with Last-Event-ID
+
+    TASK_PROGRESS_INTERVAL = float(os.environ.get('TASK_PROGRESS_INTERVAL') or 2)
+    TASK_PROGRESS_STEP = int(os.environ.get('TASK_PROGRESS_STEP') or 5)
+    #a background task reports its progress when it moved by TASK_PROGRESS_STEP percent,
+    #or by any amount after TASK_PROGRESS_INTERVAL seconds (app/progress.py)
+
+    EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(basedir, 'exports')
+    #where the post archives are written, it must be shared by the worker and the web processes for the download links
+    EXPORT_BATCH = int(os.environ.get('EXPORT_BATCH') or 1000)
+    #how many posts the export reads from the database at a time
+    EXPORT_ATTACHMENT_LIMIT = int(os.environ.get('EXPORT_ATTACHMENT_LIMIT') or 5 * 1024 * 1024)
+    #archives up to this many bytes (compressed) are attached to the email, bigger ones are sent as a download link
+    EXPORT_LINK_EXPIRES = int(os.environ.get('EXPORT_LINK_EXPIRES') or 7 * 24 * 3600)
+    #the download links work for 7 days, then the archive is deleted
+    EXPORT_URL = os.environ.get('EXPORT_URL')
+    #the address of the site, e.g. https://microblog.example.com, the worker needs it to build the download links
+    #without it the archives over EXPORT_ATTACHMENT_LIMIT can't be sent
+
+    LAST_SEEN_BACKEND = os.environ.get('LAST_SEEN_BACKEND') or \
+        ('redis' if os.environ.get('REDIS_URL') else 'memory')
+    #where the last_seen times wait before they are written: 'redis' (shared by all processes) or 'memory' (per process)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    #the buffered last_seen times are written to the database at most once every this many seconds
@@ -1,14 +1,35 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
+import gzip
+import io
+import json
+import os
+import tempfile
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import unittest.mock
+import fakeredis
+import sqlalchemy as sa
+from app import create_app, db, export, language, mail, presence, search, timeline, translate, unread
+from app.models import User, Post, Message, Notification, Task, TimelineEntry, Translation
+from app.progress import ProgressReporter
+from app.pagination import cursor_paginate, offset_paginate
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    TIMELINE_BACKEND = 'db'
+    UNREAD_COUNTER_BACKEND = 'db'
+    LAST_SEEN_BACKEND = 'memory'
+    LAST_SEEN_FLUSH_INTERVAL = 3600
+    SEARCH_INDEX_MODE = 'sync'
+    SEARCH_FTS_URL = 'sqlite://'
+    SEARCH_GENERATION_BACKEND = 'memory'
+    LANGUAGE_DETECTION_MODE = 'sync'
+    NOTIFICATION_BACKEND = 'db'
+    TRANSLATOR = 'stub'
+    TRANSLATION_CACHE_BACKEND = 'db'
 
 
 class UserModelCase(unittest.TestCase):
@@ -62,6 +83,79 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body='post from john', author=u1)
+        db.session.add_all([p1, Post(body='another post from john', author=u1)])
+        u1.follow(u2)
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 2)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+        db.session.delete(p1)
+        u2.unfollow(u1)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 1)
+        self.assertEqual(u1.followers_count(), 0)
+        self.assertEqual(u2.following_count(), 0)
+
+        # flask counters repair fixes counters that drifted
+        db.session.execute(sa.update(User).values(num_posts=7, num_followers=3))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['counters', 'repair'])
+        self.assertIn('Repaired the counters of 2 users', result.output)
+        db.session.expire_all()
+        self.assertEqual(u1.posts_count(), 1)
+        self.assertEqual(u2.posts_count(), 0)
+        self.assertEqual(u1.followers_count(), 0)
+        self.assertEqual(u1.following_count(), 1)
+
+    def test_unread_counter(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 0)
+        db.session.add_all([Message(author=u1, recipient=u2, body='hi'),
+                            Message(author=u1, recipient=u2, body='hello')])
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 2)
+        self.assertEqual(u1.unread_message_count(), 0)
+        self.assertEqual(u2.unread_message_count(), db.session.scalar(unread.count_query(u2)))
+
+        u2.last_message_read_time = datetime.now(timezone.utc)
+        unread.reset(u2)
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 0)
+        db.session.add(Message(author=u1, recipient=u2, body='again'))
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 1)
+
+        # flask counters repair recounts a counter that drifted
+        db.session.execute(sa.update(User).values(num_unread_messages=5))
+        db.session.commit()
+        self.app.test_cli_runner().invoke(args=['counters', 'repair'])
+        db.session.expire_all()
+        self.assertEqual(u1.unread_message_count(), 0)
+        self.assertEqual(u2.unread_message_count(), 1)
+
+    def test_to_dict_many(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(3)]
+        db.session.add_all(users)
+        users[0].follow(users[1])
+        db.session.commit()
+        with self.app.test_request_context():
+            self.assertEqual(User.to_dict_many(users),
+                             [user.to_dict() for user in users])
+            self.assertEqual(User.to_dict_many(users)[1]['_links']['followers'],
+                             '/api/users/2/followers')
+            self.assertEqual(User.to_dict_many(users)[1]['follower_count'], 1)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -100,6 +194,985 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        u1.follow(u2)
+        db.session.commit()
+
+        # the first read of a cold timeline rebuilds it and reads the page from it
+        self.assertEqual(timeline.paginate(u1, 10).items, [p1])
+        self.assertEqual(timeline.paginate(u1, 10).items, [p1])
+
+        # new posts are fanned out to the followers
+        p3 = Post(body="another post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [p3, p1])
+
+        # following backfills and unfollowing prunes
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [p3, p2, p1])
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [p3, p1])
+
+        # deleted posts are pruned
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [p1])
+
+    def test_empty_timeline_stays_warm(self):
+        u1 = User(username='john', email='john@example.com')
+        db.session.add(u1)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [])
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(timeline.paginate(u1, 10).items, [])
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', record)
+        # a user with nothing on their timeline is not rebuilt on every visit
+        self.assertFalse([s for s in statements if not s.lstrip().upper().startswith('SELECT')])
+        self.assertEqual(timeline.get_timeline().size(u1.id), 0)
+
+        # and the warm empty timeline receives the new posts
+        p1 = Post(body='first', author=u1)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [p1])
+
+    def test_timeline_depth(self):
+        self.app.config['TIMELINE_DEPTH'] = 2
+        u1 = User(username='john', email='john@example.com')
+        db.session.add(u1)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="first", author=u1, timestamp=now)
+        db.session.add(p1)
+        db.session.commit()
+        timeline.paginate(u1, 1)
+        for i in range(3):
+            db.session.add(Post(body=f"post {i}", author=u1,
+                                timestamp=now + timedelta(seconds=i + 1)))
+            db.session.commit()
+        entries = db.session.scalars(sa.select(TimelineEntry).where(
+            TimelineEntry.post_id != timeline.MARKER)).all()
+        self.assertEqual(len(entries), 2)
+        page = timeline.paginate(u1, 1)
+        self.assertEqual(page.items[0].body, 'post 2')
+        self.assertTrue(page.has_next)
+        # the oldest end of a full timeline falls back to the full query
+        self.assertIsNone(timeline.paginate(u1, 1, **page.next_args))
+
+    def test_redis_timeline(self):
+        self.app.config.update(TIMELINE_BACKEND='redis', TIMELINE_DEPTH=3)
+        self.app.redis = fakeredis.FakeRedis()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f"post {i}", author=u1, timestamp=now) for i in range(2)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 10).items, [posts[1], posts[0]])
+
+        # the pushes keep depth posts besides the warm marker
+        for i in range(2, 6):
+            posts.append(Post(body=f"post {i}", author=u1, timestamp=now + timedelta(seconds=i // 2)))
+            db.session.add(posts[-1])
+            db.session.commit()
+        self.assertEqual(timeline.get_timeline().size(u1.id), 3)
+        page = timeline.paginate(u1, 2)
+        self.assertEqual(page.items, [posts[5], posts[4]])
+        self.assertTrue(page.has_next)
+        # the oldest end of the full timeline falls back to the full query
+        self.assertIsNone(timeline.paginate(u1, 2, **page.next_args))
+        # posts with the same timestamp are paged by id
+        page = timeline.paginate(u1, 1)
+        self.assertEqual(page.items, [posts[5]])
+        self.assertEqual(timeline.paginate(u1, 1, **page.next_args).items, [posts[4]])
+
+        # following backfills, unfollowing prunes
+        p = Post(body="post from susan", author=u2, timestamp=now + timedelta(seconds=10))
+        db.session.add(p)
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 1).items, [p])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(timeline.paginate(u1, 1).items, [posts[5]])
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f"post {i}", author=u,
+                      timestamp=now + timedelta(seconds=i)) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        query = sa.select(Post).order_by(Post.timestamp.desc())
+        columns = (Post.timestamp, Post.id)
+
+        page1 = cursor_paginate(query, 2, columns)
+        self.assertEqual(page1.items, [posts[4], posts[3]])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+        page2 = cursor_paginate(query, 2, columns, **page1.next_args)
+        self.assertEqual(page2.items, [posts[2], posts[1]])
+        self.assertTrue(page2.has_prev)
+        page3 = cursor_paginate(query, 2, columns, **page2.next_args)
+        self.assertEqual(page3.items, [posts[0]])
+        self.assertFalse(page3.has_next)
+
+        # going back returns the same pages
+        back = cursor_paginate(query, 2, columns, **page3.prev_args)
+        self.assertEqual(back.items, page2.items)
+        back = cursor_paginate(query, 2, columns, **back.prev_args)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+
+        # a tampered cursor gives the first page
+        self.assertEqual(cursor_paginate(query, 2, columns, before='garbage').items,
+                         page1.items)
+
+    def test_offset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add_all([Post(body=f"post {i}", author=u) for i in range(5)])
+        db.session.commit()
+        query = sa.select(Post).order_by(Post.id)
+        page = offset_paginate(query, 1, 2)
+        self.assertEqual([p.body for p in page.items], ['post 0', 'post 1'])
+        self.assertTrue(page.has_next)
+        self.assertFalse(page.has_prev)
+        page = offset_paginate(query, 3, 2)
+        self.assertEqual([p.body for p in page.items], ['post 4'])
+        self.assertFalse(page.has_next)
+        self.assertEqual(page.prev_num, 2)
+        self.assertFalse(hasattr(page, 'total'))
+
+
+class RecordingElasticsearch:
+    # stands in for the Elasticsearch client, records the bulk requests
+    def __init__(self):
+        self.requests = []
+        self.refreshes = []
+        self.searches = []
+
+    def bulk(self, operations, refresh=None):
+        self.requests.append(operations)
+        self.refreshes.append(refresh)
+        items = [{op: {'_id': meta[op]['_id'], 'status': 200}}
+                 for meta in operations for op in ('index', 'delete') if op in meta]
+        return type('Response', (), {'body': {'errors': False, 'items': items}})()
+
+    def search(self, **kwargs):
+        # returns the documents of the last bulk request as hits, sorted by id like a tie on the score
+        self.searches.append(kwargs)
+        hits = [{'_id': str(meta['index']['_id']), 'sort': [1.0, meta['index']['_id']]}
+                for meta in self.requests[-1] if 'index' in meta]
+        hits.sort(key=lambda hit: hit['sort'][1], reverse=kwargs['sort'][0]['_score'] == 'desc')
+        if 'search_after' in kwargs:
+            after = kwargs['search_after'][1]
+            hits = [hit for hit in hits if (hit['sort'][1] < after if kwargs['sort'][0]['_score'] == 'desc'
+                                            else hit['sort'][1] > after)]
+        return type('Response', (), {'body': {'hits': {'hits': hits[:kwargs['size']]}}})()
+
+
+class SearchIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['SEARCH_BACKEND'] = 'elasticsearch'
+        self.app.elasticsearch = RecordingElasticsearch()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_bulk_indexing(self):
+        es = self.app.elasticsearch
+        es.requests.clear()
+        p1 = Post(body='first', author=self.user)
+        p2 = Post(body='second', author=self.user)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        # one bulk request for the whole commit
+        self.assertEqual(len(es.requests), 1)
+        self.assertEqual(es.requests[0], [
+            {'index': {'_index': 'post', '_id': p1.id}}, {'body': 'first', 'id': p1.id},
+            {'index': {'_index': 'post', '_id': p2.id}}, {'body': 'second', 'id': p2.id}])
+        # a commit waits until its changes are searchable
+        self.assertEqual(es.refreshes[-1], 'wait_for')
+
+        # only the last change of a document is sent
+        p1.body = 'changed'
+        db.session.flush()
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(es.requests[1], [{'delete': {'_index': 'post', '_id': p1.id}}])
+
+        # nothing is sent for a rolled back transaction
+        db.session.add(Post(body='rolled back', author=self.user))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(len(es.requests), 2)
+
+    def test_change_aware_indexing(self):
+        es = self.app.elasticsearch
+        post = Post(body='first', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        es.requests.clear()
+        stats = search.index_stats()
+
+        # a change to a field that is not searchable is not sent
+        post.language = 'en'
+        db.session.commit()
+        self.assertEqual(es.requests, [])
+
+        # two changes in one commit are sent once
+        post.body = 'second'
+        db.session.flush()
+        post.body = 'third'
+        db.session.commit()
+        self.assertEqual(es.requests, [[{'index': {'_index': 'post', '_id': post.id}}, {'body': 'third', 'id': post.id}]])
+        self.assertEqual(search.index_stats(), {'sent': stats['sent'] + 1, 'skipped': stats['skipped'] + 2})
+
+    def test_reindex(self):
+        es = self.app.elasticsearch
+        posts = [Post(body=f'post {i}', author=self.user) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        es.requests.clear()
+        state = os.path.join(tempfile.mkdtemp(), 'state.json')
+        result = Post.reindex(chunk_size=2, workers=1, state_path=state)
+        self.assertEqual(result['rows'], 5)
+        self.assertEqual(result['target'], 'post')
+        # one bulk request per range of 2 ids, none of them waits for a refresh
+        self.assertEqual([len(r) // 2 for r in es.requests], [2, 2, 1])
+        self.assertEqual(es.refreshes[-3:], [None, None, None])
+        self.assertFalse(os.path.exists(state))
+
+        # a resumed reindex starts where the saved one stopped
+        with open(state, 'w') as f:
+            json.dump({'index': 'post', 'target': 'post', 'swap': False, 'done': posts[4].id}, f)
+        es.requests.clear()
+        result = Post.reindex(chunk_size=2, workers=1, resume=True, state_path=state)
+        self.assertEqual(result['rows'], 1)
+        self.assertEqual(es.requests, [[{'index': {'_index': 'post', '_id': posts[4].id}},
+                                        {'body': 'post 4', 'id': posts[4].id}]])
+
+        # a range with failed documents is kept in the state file and sent again by --resume
+        with unittest.mock.patch('app.search.bulk', side_effect=[1, 0, 0]):
+            result = Post.reindex(chunk_size=2, workers=1, state_path=state)
+        self.assertEqual((result['failed'], result['complete']), (1, False))
+        with open(state) as f:
+            self.assertEqual(json.load(f)['retry'], [[posts[0].id, posts[0].id + 2]])
+        es.requests.clear()
+        result = Post.reindex(chunk_size=2, workers=1, resume=True, state_path=state)
+        self.assertEqual((result['rows'], result['complete']), (2, True))
+        self.assertEqual([len(r) // 2 for r in es.requests], [2])
+        self.assertFalse(os.path.exists(state))
+
+    def test_search_pages(self):
+        posts = [Post(body='hello', author=self.user) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        es = self.app.elasticsearch
+        page = Post.search_cursor('hello', 2)
+        self.assertEqual(page.items, [posts[4], posts[3]])
+        page = Post.search_cursor('hello', 2, **page.next_args)
+        self.assertEqual(page.items, [posts[2], posts[1]])
+        # only the searchable fields are matched, not the id field
+        self.assertEqual(es.searches[-1]['query']['multi_match']['fields'], ['body'])
+        # no point in time is opened, the ties on the score are broken by the id field
+        self.assertTrue(all('pit' not in kwargs for kwargs in es.searches))
+        self.assertEqual(es.searches[-1]['sort'][1], {'id': {'order': 'desc', 'unmapped_type': 'long'}})
+        self.assertEqual(es.searches[-1]['search_after'], [1.0, posts[3].id])
+        # the same page again comes from the result cache
+        searches = len(es.searches)
+        Post.search_cursor('hello', 2)
+        self.assertEqual(len(es.searches), searches)
+
+    def test_async_indexing(self):
+        self.app.config['SEARCH_INDEX_MODE'] = 'async'
+        self.app.config['SEARCH_BULK_INTERVAL'] = 0.01
+        es = self.app.elasticsearch
+        es.requests.clear()
+        post = Post(body='queued', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        search.get_queue().flush()
+        self.assertEqual(es.requests, [[{'index': {'_index': 'post', '_id': post.id}}, {'body': 'queued', 'id': post.id}]])
+
+
+class FullTextSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def search(self, expression):
+        posts, total = Post.search(expression, 1, 10)
+        return [post.body for post in posts], total
+
+    def test_search(self):
+        db.session.add_all([Post(body='the cat sat on the mat', author=self.user),
+                            Post(body='cat cat cat', author=self.user),
+                            Post(body='a dog barked', author=self.user)])
+        db.session.commit()
+        # best BM25 match first
+        self.assertEqual(self.search('cat'), (['cat cat cat', 'the cat sat on the mat'], 2))
+        self.assertEqual(self.search('dog OR "mat'), (['a dog barked', 'the cat sat on the mat'], 2))
+        self.assertEqual(self.search('Café -'), ([], 0))
+
+        post = db.session.scalar(sa.select(Post).where(Post.body == 'a dog barked'))
+        post.body = 'a cat barked'
+        db.session.commit()
+        self.assertEqual(self.search('dog'), ([], 0))
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.search('barked'), ([], 0))
+
+    def test_search_cursor(self):
+        db.session.add_all([Post(body='cat ' * (i % 3 + 1) + f'number{i}', author=self.user)
+                            for i in range(7)])
+        db.session.commit()
+        expected = [post.body for post in Post.search('cat', 1, 10)[0]]
+        pages, args = [], {}
+        while True:
+            page = Post.search_cursor('cat', 3, **args)
+            pages.append([post.body for post in page.items])
+            if not page.has_next:
+                break
+            args = page.next_args
+        self.assertEqual([len(items) for items in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+        # and back again from the last page
+        page = Post.search_cursor('cat', 3, **page.prev_args)
+        self.assertEqual([post.body for post in page.items], pages[1])
+        self.assertTrue(page.has_prev)
+
+        # the search page has no next link past the last page
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(self.user.id)
+        self.app.config['POSTS_PER_PAGE'] = 10
+        response = client.get('/search?q=cat')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'number6', response.data)
+        self.assertNotIn(b'before=', response.data)
+
+    def test_result_cache(self):
+        db.session.add(Post(body='hello world', author=self.user))
+        db.session.commit()
+        cache = search.get_cache()
+        self.assertEqual(self.search('hello'), (['hello world'], 1))
+        self.assertEqual(self.search('  HELLO '), (['hello world'], 1))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # a commit that changes the index makes the cached results stale
+        db.session.add(Post(body='hello again', author=self.user))
+        db.session.commit()
+        self.assertEqual(self.search('hello')[1], 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # entries expire after the TTL
+        cache.ttl = -1
+        self.search('world')
+        self.search('world')
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_reindex_new_index(self):
+        db.session.add(Post(body='hello world', author=self.user))
+        db.session.commit()
+        backend = search.get_backend()
+        with backend.engine.begin() as connection:
+            connection.execute(sa.text('DELETE FROM post'))
+        self.assertEqual(self.search('hello'), ([], 0))
+        state = os.path.join(tempfile.mkdtemp(), 'state.json')
+        result = Post.reindex(workers=1, new_index=True, state_path=state)
+        self.assertNotEqual(result['target'], 'post')
+        self.assertEqual(self.search('hello'), (['hello world'], 1))
+
+
+class TranslationCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_two_tiers(self):
+        self.assertEqual(translate.translate('hola', 'es', 'en_US'), '[en] hola')
+        self.assertEqual(translate.translate('hola', 'es', 'en_GB'), '[en] hola')
+        # the region is dropped, so the second call is a hit of the local tier
+        self.assertEqual(translate.translation_stats()['upstream'], 1)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Translation)), 1)
+
+        # a new process starts with an empty local tier and reads the shared one
+        del self.app.extensions['translation_cache']
+        self.assertEqual(translate.translate_many(['hola', 'adios', 'hola'], 'es', 'fr'),
+                         ['[fr] hola', '[fr] adios', '[fr] hola'])
+        self.assertEqual(translate.translate('hola', 'es', 'en'), '[en] hola')
+        self.assertEqual(translate.translate('adios', 'es', 'fr'), '[fr] adios')
+        stats = translate.translation_stats()
+        self.assertEqual(stats['upstream'], 2)
+        self.assertEqual(stats['shared_hits'], 1)
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_errors_are_not_cached(self):
+        self.app.config['TRANSLATOR'] = 'microsoft'
+        self.app.config['MS_TRANSLATOR_KEY'] = None
+        with self.app.test_request_context():
+            self.assertEqual(translate.translate('hola', 'es', 'en'),
+                             'Error: the translation service is not configured.')
+        self.app.config['TRANSLATOR'] = 'stub'
+        self.assertEqual(translate.translate('hola', 'es', 'en'), '[en] hola')
+
+    def test_batch_endpoint(self):
+        user = User(username='john', email='john@example.com')
+        posts = [Post(body='hola', author=user, language='es'),
+                 Post(body='adios', author=user, language='es'),
+                 Post(body='bonjour', author=user, language='fr'),
+                 Post(body='hello', author=user, language='')]
+        db.session.add_all(posts)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+        response = client.post('/translate/batch', json={'posts': [
+            {'id': post.id, 'dest_language': 'en_US'} for post in posts]})
+        self.assertEqual(response.status_code, 200)
+        translations = {item['id']: item['text'] for item in response.get_json()['translations']}
+        self.assertEqual(translations, {posts[0].id: '[en] hola', posts[1].id: '[en] adios',
+                                        posts[2].id: '[en] bonjour'})
+        # one translator call per language pair, the post without a language is left out
+        self.assertEqual(translate.translation_stats()['upstream_calls'], 2)
+        self.assertEqual(client.post('/translate/batch', json={'posts': [{'id': 'x'}]}).status_code, 400)
+
+    def test_pretranslate(self):
+        now = datetime.now(timezone.utc)
+        old = now - timedelta(days=3)
+        john = User(username='john', email='john@example.com', locale='en_US', last_seen=now)
+        maria = User(username='maria', email='maria@example.com', locale='es', last_seen=now)
+        away = User(username='away', email='away@example.com', locale='de', last_seen=old)
+        db.session.add_all([john, maria, away,
+                            Post(body='hola', author=maria, language='es', timestamp=now),
+                            Post(body='hello', author=john, language='en', timestamp=now),
+                            Post(body='salut', author=john, language='fr', timestamp=now),
+                            Post(body='ciao', author=john, language='it', timestamp=old),
+                            Post(body='no language', author=john, language='', timestamp=now)])
+        db.session.commit()
+        translate.translate('hola', 'es', 'en')
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['translate', 'prewarm', '--sync'])
+        # hello -> es, salut -> en and es, hola -> en was cached, ciao is too old, nobody reads German
+        self.assertIn('Translated 3 texts', result.output)
+        self.assertIn('into en, es, 1 were already cached', result.output)
+        before = translate.translation_stats()['upstream']
+        self.assertEqual(translate.translate('salut', 'fr', 'es'), '[es] salut')
+        self.assertEqual(translate.translation_stats()['upstream'], before)
+
+        db.session.execute(sa.delete(Translation))
+        db.session.commit()
+        result = runner.invoke(args=['translate', 'prewarm', '--sync', '--budget', '6'])
+        self.assertIn('Stopped at the character budget', result.output)
+
+        # the batches are read on connections of their own, what the caller had pending is not rolled back
+        john.about_me = 'pending'
+        translate.pretranslate()
+        self.assertEqual(john.about_me, 'pending')
+
+    def test_language_detection(self):
+        user = User(username='john', email='john@example.com')
+        post = Post(body='Este es un mensaje escrito en español', author=user)
+        db.session.add(post)
+        db.session.flush()
+        self.assertIsNone(post.language)
+        db.session.commit()
+        # detected after the commit
+        self.assertEqual(post.language, 'es')
+
+        texts = ['Ceci est un message écrit en français', 'This is a message written in English', '123']
+        self.assertEqual(language.detect(texts), ['fr', 'en', ''])
+        self.assertEqual(language.detect(texts), language.detect(texts))
+
+        self.app.config['LANGUAGE_DETECTION_MODE'] = 'async'
+        with unittest.mock.patch.object(language, 'schedule') as schedule:
+            db.session.add_all([Post(body=text, author=user) for text in texts])
+            db.session.commit()
+        self.assertEqual(len(schedule.call_args.args[0]), 3)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).where(Post.language.is_(None))), 3)
+        result = self.app.test_cli_runner().invoke(args=['language', 'backfill'])
+        self.assertIn('Detected the language of 3 posts', result.output)
+        self.assertEqual(db.session.scalars(sa.select(Post.language).order_by(Post.id)).all(),
+                         ['es', 'fr', 'en', ''])
+
+
+class PubSubRedis:
+    # stands in for the redis client, an in-process PUBLISH/SUBSCRIBE
+    def __init__(self):
+        self.subscribers = []
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def publish(self, channel, data):
+        for pubsub in self.subscribers:
+            if channel in pubsub.channels:
+                pubsub.messages.append({'type': 'message', 'channel': channel, 'data': data})
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        pubsub = type('PubSub', (), {})()
+        pubsub.channels, pubsub.messages = set(), []
+        pubsub.subscribe = pubsub.channels.add
+        pubsub.get_message = lambda timeout: pubsub.messages.pop(0) if pubsub.messages else None
+        pubsub.close = lambda: self.subscribers.remove(pubsub)
+        self.subscribers.append(pubsub)
+        return pubsub
+
+
+class NotificationStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.user.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_polling_fallback(self):
+        self.user.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(self.client.get('/notifications/stream').status_code, 204)
+        data = self.client.get('/notifications?since=0').get_json()
+        self.assertEqual([(n['name'], n['data']) for n in data], [('unread_message_count', 2)])
+
+    def test_send_message(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add(susan)
+        db.session.commit()
+        commits = []
+
+        def record(session):
+            commits.append(session)
+        sa.event.listen(db.session, 'after_commit', record)
+        try:
+            for _ in range(2):
+                self.client.post('/send_message/susan', data={'message': 'hi'})
+        finally:
+            sa.event.remove(db.session, 'after_commit', record)
+        # one commit per message, and the notification has the new count
+        self.assertEqual(len(commits), 2)
+        notification = db.session.scalar(susan.notifications.select())
+        self.assertEqual(notification.get_data(), 2)
+        self.assertEqual(db.session.get(User, susan.id).num_unread_messages, 2)
+
+    def test_upsert(self):
+        for count in range(3):
+            self.user.add_notification('unread_message_count', count)
+            db.session.commit()
+        self.user.add_notification('task_progress', {'task_id': 'x', 'progress': 10})
+        db.session.commit()
+        rows = db.session.scalars(self.user.notifications.select().order_by(Notification.name)).all()
+        self.assertEqual([(n.name, n.get_data()) for n in rows],
+                         [('task_progress', {'task_id': 'x', 'progress': 10}), ('unread_message_count', 2)])
+        with self.assertRaises(sa.exc.IntegrityError):
+            db.session.add(Notification(name='task_progress', payload_json='0', user=self.user))
+            db.session.commit()
+        db.session.rollback()
+
+    def test_stream(self):
+        self.app.config['NOTIFICATION_STREAM'] = 'redis'
+        self.app.redis = PubSubRedis()
+        self.user.add_notification('unread_message_count', 2)
+        db.session.commit()
+
+        response = self.client.get('/notifications/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = iter(response.response)
+        self.assertTrue(next(stream).startswith(b'retry: '))
+        self.assertIn(b'"unread_message_count"', next(stream))
+        self.assertEqual(next(stream), b': heartbeat\n\n')
+        # published to the open stream after the commit
+        self.user.add_notification('task_progress', {'task_id': 'x', 'progress': 50})
+        db.session.commit()
+        event = next(stream).decode()
+        self.assertIn('"task_progress"', event)
+        last_event_id = event.split('\n')[0][len('id: '):]
+        response.close()
+        self.assertEqual(self.app.redis.subscribers, [])
+
+        # a reconnect only gets what came after Last-Event-ID
+        response = self.client.get('/notifications/stream', headers={'Last-Event-ID': last_event_id},
+                                   buffered=False)
+        stream = iter(response.response)
+        next(stream)
+        self.assertEqual(next(stream), b': heartbeat\n\n')
+        response.close()
+
+    def test_stream_limit(self):
+        self.app.config['NOTIFICATION_STREAM'] = 'redis'
+        self.app.config['NOTIFICATION_STREAM_LIMIT'] = 1
+        self.app.redis = PubSubRedis()
+        response = self.client.get('/notifications/stream', buffered=False)
+        next(iter(response.response))
+        # the process is at its limit, the next tab polls
+        self.assertEqual(self.client.get('/notifications/stream').status_code, 204)
+        response.close()
+        response = self.client.get('/notifications/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        next(iter(response.response))
+        response.close()
+
+
+class RecordingJob:
+    # stands in for the current RQ job, records the saved progress
+    def __init__(self, id):
+        self.id = id
+        self.meta = {}
+        self.saved = []
+
+    def get_id(self):
+        return self.id
+
+    def save_meta(self):
+        self.saved.append(self.meta['progress'])
+
+
+class ProgressReporterCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_throttling(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add(Task(id='job1', name='export_posts', description='Exporting', user=user))
+        db.session.commit()
+        job = RecordingJob('job1')
+        progress = ProgressReporter(1000, interval=3600, step=10, job=job)
+        for i in range(1, 1001):
+            progress.update(i)
+        self.assertEqual(job.saved, [0, 10, 20, 30, 40, 50, 60, 70, 80, 90])
+        # 100 is only sent by finish(), which completes the task
+        self.assertFalse(db.session.get(Task, 'job1').complete)
+        progress.finish()
+        progress.finish()
+        self.assertEqual(job.saved[-1], 100)
+        self.assertEqual(progress.reports, 11)
+        self.assertTrue(db.session.get(Task, 'job1').complete)
+        notification = db.session.scalar(user.notifications.select())
+        self.assertEqual(notification.get_data(), {'task_id': 'job1', 'progress': 100})
+
+        # with a short interval, small steps are sent once it has passed
+        job = RecordingJob('job1')
+        progress = ProgressReporter(1000, interval=0, step=50, job=job)
+        for i in range(0, 30, 10):
+            progress.update(i)
+        self.assertEqual(job.saved, [0, 1, 2])
+
+    def test_batched_progress_lookup(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add_all([Task(id=f'job{i}', name='export_posts', description='Exporting', user=user)
+                            for i in range(3)])
+        db.session.commit()
+        running = RecordingJob('job0')
+        running.meta['progress'] = 40
+        with unittest.mock.patch('rq.job.Job.fetch_many', return_value=[running, None, RecordingJob('job2')]) \
+                as fetch_many, self.app.test_request_context():
+            tasks = user.get_tasks_progress()
+            self.assertEqual([(task.id, progress) for task, progress in tasks], [('job0', 40), ('job2', 0)])
+            # the second call in the same request is served from the request cache
+            self.assertIs(user.get_tasks_progress(), tasks)
+        fetch_many.assert_called_once()
+        self.assertEqual(fetch_many.call_args.args[0], ['job0', 'job1', 'job2'])
+        # the task whose job vanished is marked complete
+        db.session.expire_all()
+        self.assertEqual([task.id for task in user.get_tasks_in_progress()], ['job0', 'job2'])
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app(TestConfig)
+        self.app.config['EXPORT_DIR'] = self.directory.name
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        now = datetime.now(timezone.utc)
+        self.user = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body=f'post {i}', author=self.user, language='',
+                                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def test_write_posts(self):
+        job = RecordingJob('job1')
+        progress = ProgressReporter(5, interval=3600, step=1, job=job)
+        f = io.BytesIO()
+        self.user.about_me = 'pending'
+        self.assertEqual(export.write_posts(self.user, f, progress, batch=2), 5)
+        # the batches are read on connections of their own, what the caller had pending is not rolled back
+        self.assertEqual(self.user.about_me, 'pending')
+        lines = gzip.decompress(f.getvalue()).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['body'] for line in lines], [f'post {i}' for i in range(5)])
+        self.assertTrue(json.loads(lines[0])['timestamp'].endswith('Z'))
+        # the progress is updated after each batch
+        self.assertEqual(job.saved, [40, 80, 99])
+
+    def test_attachment_and_link(self):
+        path = export.new_file(self.user)
+        with open(path, 'wb') as f:
+            export.write_posts(self.user, f)
+        with mail.record_messages() as outbox:
+            self.assertIsNone(export.send_archive(self.user, path))
+        self.assertEqual(outbox[0].attachments[0].filename, 'posts.ndjson.gz')
+        self.assertFalse(os.path.exists(path))
+
+        # an archive over the limit stays on disk and the email has a download link
+        self.app.config.update(EXPORT_ATTACHMENT_LIMIT=0, EXPORT_URL='https://microblog.example.com')
+        path = export.new_file(self.user)
+        with open(path, 'wb') as f:
+            export.write_posts(self.user, f)
+        with mail.record_messages() as outbox:
+            link = export.send_archive(self.user, path)
+        self.assertTrue(link.startswith('https://microblog.example.com/export/'))
+        self.assertIn(link, outbox[0].body)
+        self.assertFalse(outbox[0].attachments)
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(self.user.id)
+        url = link.replace('https://microblog.example.com', '')
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(gzip.decompress(response.data).splitlines()), 5)
+        response.close()
+        self.assertEqual(client.get('/export/invalid').status_code, 404)
+
+        # someone else can't use the link
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add(susan)
+        db.session.commit()
+        token = url.rsplit('/', 1)[1]
+        self.assertEqual(export.verify_token(token, self.user), path)
+        self.assertIsNone(export.verify_token(token, susan))
+
+        # the archive is deleted once the link has expired
+        self.assertEqual(export.prune(), 0)
+        os.utime(path, (0, 0))
+        self.assertEqual(export.prune(), 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_too_big_without_url(self):
+        # without EXPORT_URL an archive over the limit is neither attached nor linked
+        self.app.config['EXPORT_ATTACHMENT_LIMIT'] = 0
+        path = export.new_file(self.user)
+        with open(path, 'wb') as f:
+            export.write_posts(self.user, f)
+        with mail.record_messages() as outbox:
+            self.assertIsNone(export.send_archive(self.user, path))
+        self.assertFalse(outbox[0].attachments)
+        self.assertIn('too big', outbox[0].body)
+        self.assertFalse(os.path.exists(path))
+
+
+class FileDatabaseCase(unittest.TestCase):
+    # sqlite:// shares one connection, a database file has a connection per checkout and real locks,
+    # like the default app.db
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory.name, 'app.db')
+        self.app = create_app(FileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        now = datetime.now(timezone.utc)
+        self.user = User(username='john', email='john@example.com', locale='en', last_seen=now)
+        db.session.add(self.user)
+        db.session.add_all([Post(body=f'hola {i}', author=self.user, language='es',
+                                 timestamp=now - timedelta(seconds=i)) for i in range(7)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def test_pretranslate(self):
+        # the translations are written between the batches, while no read is open
+        result = translate.pretranslate(batch=2)
+        self.assertEqual((result['posts'], result['translated']), (7, 7))
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Translation)), 7)
+
+    def test_export(self):
+        # the progress of the export is committed between the batches, while no read is open
+        db.session.add(Task(id='job1', name='export_posts', description='Exporting', user=self.user))
+        db.session.commit()
+        job = RecordingJob('job1')
+        progress = ProgressReporter(7, interval=3600, step=1, job=job)
+        f = io.BytesIO()
+        self.assertEqual(export.write_posts(self.user, f, progress, batch=2), 7)
+        lines = gzip.decompress(f.getvalue()).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['body'] for line in lines], [f'hola {i}' for i in reversed(range(7))])
+        self.assertEqual(job.saved, [28, 57, 85, 99])
+        notification = db.session.scalar(self.user.notifications.select())
+        self.assertEqual(notification.get_data()['progress'], 99)
+
+
+class PostListingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        # ten authors with two posts each, all followed by john
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        now = datetime.now(timezone.utc)
+        for i in range(10):
+            author = User(username=f'user{i}', email=f'user{i}@example.com')
+            db.session.add(author)
+            self.user.follow(author)
+            db.session.add_all([Post(body=f'post {i} {j}', author=author,
+                                     timestamp=now + timedelta(seconds=2 * i + j))
+                                for j in range(2)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.user.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_queries(self, url, per_page):
+        return len(self.run_queries(url, per_page))
+
+    def run_queries(self, url, per_page):
+        self.app.config['POSTS_PER_PAGE'] = per_page
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = self.client.get(url)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(response.status_code, 200)
+        return statements
+
+    def test_post_pages_query_count(self):
+        # the number of queries must not grow with the number of posts on the page
+        for url in ['/index', '/explore', '/user/user3', '/search?q=post']:
+            self.count_queries(url, 2)  # warms the home timeline
+            self.assertEqual(self.count_queries(url, 2),
+                             self.count_queries(url, 8), url)
+
+    def test_search_query_count(self):
+        # the search hits and their authors are loaded with a fixed number of queries
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        for per_page in (2, 8):
+            statements.clear()
+            sa.event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                posts, total = Post.search('post', 1, per_page)
+                authors = [post.author.username for post in posts]
+            finally:
+                sa.event.remove(db.engine, 'before_cursor_execute', count)
+            self.assertEqual(len(authors), per_page)
+            self.assertEqual(total, 20)
+            self.assertEqual(len(statements), 2)
+            # one query for the posts, one for their authors
+
+    def test_last_seen_is_buffered(self):
+        last_seen = self.user.last_seen
+        statements = self.run_queries('/explore', 3)
+        # a page view no longer writes to the database
+        self.assertFalse([s for s in statements if s.lstrip().upper().startswith('UPDATE')])
+        db.session.expire_all()
+        self.assertEqual(self.user.last_seen, last_seen)
+        result = self.app.test_cli_runner().invoke(args=['last-seen', 'flush'])
+        self.assertIn('Updated last_seen of 1 users', result.output)
+        db.session.expire_all()
+        self.assertGreater(self.user.last_seen, last_seen)
+        self.assertEqual(self.user.locale, 'en')
+        self.assertEqual(presence.flush(), 0)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)